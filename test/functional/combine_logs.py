@@ -8,14 +8,19 @@ If no argument is provided, the most recent test directory will be used."""
 
 import argparse
 from collections import defaultdict, namedtuple
+import contextlib
 import glob
 import heapq
+import io
 import itertools
+import mmap
 import os
 import pathlib
+import random
 import re
 import sys
 import tempfile
+import unittest
 
 # N.B.: don't import any local modules here - this script must remain executable
 # without the parent module installed.
@@ -25,6 +30,11 @@ TMPDIR_PREFIX = "defi_func_test_"
 
 # Matches on the date format at the start of the log event
 TIMESTAMP_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d{6})?Z")
+# Same, for matching at an offset of a mmapped log file (match() anchors at the offset)
+TIMESTAMP_PATTERN_BYTES = re.compile(rb"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d{6})?Z")
+
+# Continuation lines of an event are indented by the width of source and timestamp
+CONTINUATION_INDENT = " " * 35
 
 LogEvent = namedtuple('LogEvent', ['timestamp', 'source', 'event'])
 
@@ -38,6 +48,9 @@ def main():
               'Defaults to the most recent'))
     parser.add_argument('-c', '--color', dest='color', action='store_true', help='outputs the combined log with events colored by source (requires posix terminal colors. Use less -r for viewing)')
     parser.add_argument('--html', dest='html', action='store_true', help='outputs the combined log as html. Requires jinja2. pip install jinja2')
+    parser.add_argument('--since', help='only output events at or after this time (e.g. 2021-06-01T12:00:05, a prefix of the log timestamps is enough)')
+    parser.add_argument('--until', help='only output events before this time')
+    parser.add_argument('--source', help='only output events from these comma-separated sources (e.g. test,node1)')
     args = parser.parse_args()
 
     if args.html and args.color:
@@ -62,7 +75,7 @@ def main():
         colors["node3"] = "\033[0;33m"  # YELLOW
         colors["reset"] = "\033[0m"  # Reset font color
 
-    log_events = read_logs(testdir)
+    log_events = read_logs(testdir, since=args.since, until=args.until, sources=args.source.split(',') if args.source else None)
 
     if args.html:
         print_logs_html(log_events)
@@ -71,17 +84,26 @@ def main():
         print_node_warnings(testdir, colors)
 
 
-def read_logs(tmp_dir):
+def read_logs(tmp_dir, *, since=None, until=None, sources=None):
     """Reads log files.
 
     Delegates to generator function get_log_events() to provide individual log events
-    for each of the input log files."""
+    for each of the input log files, optionally only those between since and until
+    and from the given sources, and merges them by timestamp."""
+    files = get_log_files(tmp_dir)
+    if sources is not None:
+        files = [(source, f) for source, f in files if source in sources]
+
+    return heapq.merge(*[get_log_events(source, f, since=since, until=until) for source, f in files])
 
+
+def get_log_files(tmp_dir):
+    """Return [(source, path)] of the test framework log and the node debug logs of a test directory."""
     # Find out what the folder is called that holds the debug.log file
     chain = glob.glob("{}/node0/*/debug.log".format(tmp_dir))
     if chain:
         chain = chain[0]  # pick the first one if more than one chain was found (should never happen)
-        chain = re.search('node0/(.+?)/debug\.log$', chain).group(1)  # extract the chain name
+        chain = re.search(r'node0/(.+?)/debug\.log$', chain).group(1)  # extract the chain name
     else:
         chain = 'regtest'  # fallback to regtest (should only happen when none exists)
 
@@ -91,8 +113,7 @@ def read_logs(tmp_dir):
         if not os.path.isfile(logfile):
             break
         files.append(("node%d" % i, logfile))
-
-    return heapq.merge(*[get_log_events(source, f) for source, f in files])
+    return files
 
 
 def print_node_warnings(tmp_dir, colors):
@@ -137,41 +158,95 @@ def find_latest_test_dir():
     return max(testdir_paths, key=os.path.getmtime) if testdir_paths else None
 
 
-def get_log_events(source, logfile):
+def get_log_events(source, logfile, *, since=None, until=None):
     """Generator function that returns individual log events.
 
     Log events may be split over multiple lines. We use the timestamp
-    regex match as the marker for a new log event."""
+    regex match as the marker for a new log event.
+
+    The file is mmapped and scanned line by line for timestamps, so an event,
+    including its continuation lines, is one slice of the file that is decoded
+    once. Log timestamps only increase, so the first event at or after `since`
+    is found by bisecting the file and reading stops at the first event at or
+    after `until`."""
     try:
-        with open(logfile, 'r', encoding='utf-8') as infile:
-            event = ''
-            timestamp = ''
-            for line in infile:
-                # skip blank lines
-                if line == '\n':
-                    continue
-                # if this line has a timestamp, it's the start of a new log event.
-                time_match = TIMESTAMP_PATTERN.match(line)
-                if time_match:
-                    if event:
-                        yield LogEvent(timestamp=timestamp, source=source, event=event.rstrip())
-                    timestamp = time_match.group()
-                    if time_match.group(1) is None:
-                        # timestamp does not have microseconds. Add zeroes.
-                        timestamp_micro = timestamp.replace("Z", ".000000Z")
-                        line = line.replace(timestamp, timestamp_micro)
-                        timestamp = timestamp_micro
-                    event = line
-                # if it doesn't have a timestamp, it's a continuation line of the previous log.
-                else:
-                    # Add the line. Prefix with space equivalent to the source + timestamp so log lines are aligned
-                    event += "                                   " + line
-            # Flush the final event
-            yield LogEvent(timestamp=timestamp, source=source, event=event.rstrip())
+        with open(logfile, 'rb') as infile:
+            if os.fstat(infile.fileno()).st_size == 0:
+                return
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                pos = find_event_start(buf, since.encode()) if since else 0
+                for start, end, time_match in scan_events(buf, pos):
+                    timestamp = time_match.group().decode()
+                    if until and timestamp >= until:
+                        return
+                    yield make_log_event(source, buf[start:end], timestamp)
     except FileNotFoundError:
         print("File %s could not be opened. Continuing without it." % logfile, file=sys.stderr)
 
 
+def scan_events(buf, pos=0):
+    """Generator over the log events of a mmapped log from offset pos, as (start, end, timestamp match)."""
+    size = len(buf)
+    start = None
+    event_match = None
+    while pos < size:
+        end = buf.find(b'\n', pos)
+        if end == -1:
+            end = size
+        # if this line has a timestamp, it's the start of a new log event.
+        # Otherwise it's a continuation line of the previous log.
+        time_match = TIMESTAMP_PATTERN_BYTES.match(buf, pos)
+        if time_match:
+            if start is not None:
+                yield start, pos, event_match
+            start = pos
+            event_match = time_match
+        pos = end + 1
+    # Flush the final event
+    if start is not None:
+        yield start, size, event_match
+
+
+def make_log_event(source, data, timestamp):
+    """Build a LogEvent from the bytes of one event, starting with `timestamp`."""
+    event = data.decode('utf-8', errors='replace').rstrip()
+    if "." not in timestamp:
+        # timestamp does not have microseconds. Add zeroes.
+        timestamp_micro = timestamp.replace("Z", ".000000Z")
+        event = event.replace(timestamp, timestamp_micro, 1)
+        timestamp = timestamp_micro
+    if "\n" in event:
+        # Skip blank lines and prefix the others with space equivalent to the source + timestamp so log lines are aligned
+        lines = event.split("\n")
+        event = "\n".join([lines[0]] + [CONTINUATION_INDENT + line for line in lines[1:] if line])
+    return LogEvent(timestamp=timestamp, source=source, event=event)
+
+
+def next_event_start(buf, pos):
+    """Return the offset of the first line at or after `pos` that starts a log event, or len(buf)."""
+    size = len(buf)
+    if pos > 0 and buf[pos - 1:pos] != b'\n':
+        pos = buf.find(b'\n', pos)
+        pos = size if pos == -1 else pos + 1
+    while pos < size and not TIMESTAMP_PATTERN_BYTES.match(buf, pos):
+        pos = buf.find(b'\n', pos)
+        pos = size if pos == -1 else pos + 1
+    return pos
+
+
+def find_event_start(buf, since):
+    """Return the offset of the first log event with a timestamp at or after `since` (bytes)."""
+    lo, hi = 0, len(buf)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        pos = next_event_start(buf, mid)
+        if pos >= len(buf) or buf[pos:pos + len(since)] >= since:
+            hi = mid
+        else:
+            lo = pos + 1
+    return next_event_start(buf, lo)
+
+
 def print_logs_plain(log_events, colors):
     """Renders the iterator of log events into text."""
     for event in log_events:
@@ -182,16 +257,100 @@ def print_logs_plain(log_events, colors):
                 print("{0}{1}{2}".format(colors[event.source.rstrip()], line, colors["reset"]))
 
 
-def print_logs_html(log_events):
-    """Renders the iterator of log events into html."""
+def print_logs_html(log_events, title="Combined Logs from testcase"):
+    """Renders the iterator of log events into html.
+
+    The template is streamed, so events are rendered as they are read."""
     try:
         import jinja2
     except ImportError:
         print("jinja2 not found. Try `pip install jinja2`")
         sys.exit(1)
-    print(jinja2.Environment(loader=jinja2.FileSystemLoader('./'))
-                    .get_template('combined_log_template.html')
-                    .render(title="Combined Logs from testcase", log_events=[event._asdict() for event in log_events]))
+    template = (jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.dirname(os.path.realpath(__file__))))
+                .get_template('combined_log_template.html'))
+    for chunk in template.generate(title=title, log_events=(event._asdict() for event in log_events)):
+        sys.stdout.write(chunk)
+    sys.stdout.write('\n')
+
+
+class TestCombineLogs(unittest.TestCase):
+    def make_log(self, rng, num_events):
+        """Return a log of num_events events with repeated timestamps, continuation
+        and blank lines, and the offsets and timestamps of its events."""
+        lines = [b"a line before the first event\n"]
+        offset = len(lines[0])
+        events = []
+        second = micros = 0
+        for i in range(num_events):
+            step = rng.choice([0, 0, 1, 2])
+            micros = micros + rng.randrange(2) if step == 0 else 0
+            second += step
+            timestamp = "2021-06-01T12:{:02d}:{:02d}.{:06d}Z".format(second // 60, second % 60, micros)
+            event = ["{} event {}\n".format(timestamp, i).encode()]
+            event += [b"  continued\n", b"\n"][:rng.randrange(3)]
+            events.append((offset, timestamp))
+            lines += event
+            offset += sum(len(line) for line in event)
+        return b"".join(lines), events
+
+    def test_scan_events(self):
+        self.assertEqual(list(scan_events(b"")), [])
+        self.assertEqual(list(scan_events(b"no timestamps\nat all\n")), [])
+        rng = random.Random(1)
+        for _ in range(20):
+            buf, events = self.make_log(rng, rng.randrange(1, 30))
+            # The last event may end without a newline
+            if rng.randrange(2):
+                buf = buf.rstrip(b"\n")
+            scanned = list(scan_events(buf))
+            self.assertEqual([(start, m.group().decode()) for start, _, m in scanned], events)
+            self.assertEqual([end for _, end, _ in scanned], [start for start, _ in events[1:]] + [len(buf)])
+            # Scanning from the start of an event skips the events before it
+            middle = events[len(events) // 2][0]
+            self.assertEqual(list(scan_events(buf, middle))[0][0], middle)
+
+    def test_find_event_start(self):
+        self.assertEqual(find_event_start(b"", b"2021"), 0)
+        rng = random.Random(2)
+        for _ in range(20):
+            buf, events = self.make_log(rng, rng.randrange(1, 50))
+            timestamps = sorted({t for _, t in events})
+            # Every timestamp, prefixes of them, and times before, between and after the events
+            queries = timestamps + [t[:16] for t in timestamps] + ["2021-06-01T11", "2021-06-01T12:00:00.5", "2021-06-02"]
+            for since in queries:
+                expected = next((start for start, t in events if t >= since), len(buf))
+                self.assertEqual(find_event_start(buf, since.encode()), expected, since)
+
+    def test_get_log_events(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            logfile = os.path.join(tmp_dir, "debug.log")
+            with open(logfile, 'w', encoding='utf8') as f:
+                f.write("2021-06-01T12:00:01Z first\n"
+                        "2021-06-01T12:00:02.000001Z second\n"
+                        "  continued\n"
+                        "\n"
+                        "  again\n"
+                        "2021-06-01T12:00:03.000000Z third\n")
+            events = list(get_log_events("node0", logfile))
+            # Timestamps without microseconds get zero microseconds
+            self.assertEqual(events[0], LogEvent("2021-06-01T12:00:01.000000Z", "node0", "2021-06-01T12:00:01.000000Z first"))
+            # Continuation lines are indented and blank lines dropped
+            self.assertEqual(events[1].event, "2021-06-01T12:00:02.000001Z second\n" + CONTINUATION_INDENT + "  continued\n" + CONTINUATION_INDENT + "  again")
+            self.assertEqual(len(events), 3)
+
+            def timestamps(**kwargs):
+                return [e.timestamp for e in get_log_events("node0", logfile, **kwargs)]
+            self.assertEqual(timestamps(since="2021-06-01T12:00:02"), ["2021-06-01T12:00:02.000001Z", "2021-06-01T12:00:03.000000Z"])
+            self.assertEqual(timestamps(until="2021-06-01T12:00:03"), ["2021-06-01T12:00:01.000000Z", "2021-06-01T12:00:02.000001Z"])
+            self.assertEqual(timestamps(since="2021-06-01T12:00:02", until="2021-06-01T12:00:03"), ["2021-06-01T12:00:02.000001Z"])
+            self.assertEqual(timestamps(since="2021-06-01T12:00:04"), [])
+
+            open(logfile, 'w', encoding='utf8').close()
+            self.assertEqual(timestamps(), [])
+            stderr = io.StringIO()
+            with contextlib.redirect_stderr(stderr):
+                self.assertEqual(list(get_log_events("node1", os.path.join(tmp_dir, "missing.log"))), [])
+            self.assertIn("could not be opened", stderr.getvalue())
 
 
 if __name__ == '__main__':
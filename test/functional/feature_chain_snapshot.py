@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Copyright (c) DeFi Blockchain Developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+"""Test restore_or_build_snapshot().
+
+- build the token setup once and save it as a snapshot
+- rewind the nodes to the tips they had before the build
+- restore the snapshot instead of building again, with the same chain,
+  tokens, wallets, mocktime and connections
+- a different starting tip builds a new snapshot
+"""
+
+from test_framework.test_framework import DefiTestFramework
+from test_framework.test_node import TestNode
+from test_framework.util import assert_equal
+
+
+class ChainSnapshotTest(DefiTestFramework):
+    def set_test_params(self):
+        self.num_nodes = 2
+        self.setup_clean_chain = True
+        self.extra_args = [
+            ['-txnotokens=0', '-amkheight=50', '-bayfrontheight=50'],
+            ['-txnotokens=0', '-amkheight=50', '-bayfrontheight=50']]
+
+    def build_tokens(self):
+        self.builds += 1
+        self.setup_tokens()
+
+    def build_blocks(self):
+        self.builds += 1
+        self.nodes[0].generate(5)
+        self.sync_blocks()
+
+    def get_state(self):
+        return [(node.getbestblockhash(), node.listtokens(), node.getbalances(), node.getconnectioncount()) for node in self.nodes]
+
+    def run_test(self):
+        self.builds = 0
+        genesis = self.nodes[0].getbestblockhash()
+
+        self.log.info("Build the snapshot")
+        self.restore_or_build_snapshot("tokens", self.build_tokens)
+        assert_equal(self.builds, 1)
+        assert_equal(len(self.nodes[0].listtokens()), 3)
+        state = self.get_state()
+        mocktime = TestNode.Mocktime
+
+        self.log.info("Rewind to the tips before the build")
+        for node in self.nodes:
+            node.invalidateblock(node.getblockhash(1))
+            assert_equal(node.getbestblockhash(), genesis)
+            assert_equal(len(node.listtokens()), 1)
+        self.nodes[0].reset_mocktime()
+
+        self.log.info("Restore the snapshot")
+        self.restore_or_build_snapshot("tokens", self.build_tokens)
+        assert_equal(self.builds, 1)
+        assert_equal(TestNode.Mocktime, mocktime)
+        assert_equal(self.get_state(), state)
+        symbolGOLD = "GOLD#" + self.get_id_token("GOLD")
+        self.nodes[0].minttokens("10@" + symbolGOLD)
+        self.nodes[0].generate(1)
+        self.sync_blocks()
+
+        self.log.info("A different starting tip builds a new snapshot")
+        height = self.nodes[0].getblockcount()
+        self.restore_or_build_snapshot("blocks", self.build_blocks)
+        self.restore_or_build_snapshot("blocks", self.build_blocks)
+        assert_equal(self.builds, 3)
+        assert_equal(self.nodes[1].getblockcount(), height + 10)
+
+
+if __name__ == '__main__':
+    ChainSnapshotTest().main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# Copyright (c) DeFi Blockchain Developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+"""Test generate() minting several blocks per generatetoaddress call (--generatechunk).
+
+Check that chunked generation returns the hashes of the minted blocks in chain
+order, advances the height by the requested number of blocks and only mints
+blocks with a time after the median time past of their parent, with and
+without mocktime, and that one-at-a-time generation continues from there.
+"""
+
+import time
+
+from test_framework.test_framework import DefiTestFramework
+from test_framework.util import assert_equal, assert_greater_than
+
+
+class GenerateChunkTest(DefiTestFramework):
+    def set_test_params(self):
+        self.num_nodes = 1
+        self.setup_clean_chain = True
+
+    def check_generate(self, nblocks, chunk):
+        node = self.nodes[0]
+        height = node.getblockcount()
+        hashes = node.generate(nblocks, chunk=chunk)
+        assert_equal(len(hashes), nblocks)
+        assert_equal(node.getblockcount(), height + nblocks)
+        assert_equal(node.getbestblockhash(), hashes[-1])
+
+        prev = node.getblockheader(node.getblockhash(height))
+        for i, block_hash in enumerate(hashes):
+            header = node.getblockheader(block_hash)
+            assert_equal(header['height'], height + i + 1)
+            assert_equal(header['previousblockhash'], prev['hash'])
+            assert_greater_than(header['time'], prev['mediantime'])
+            prev = header
+
+    def run_test(self):
+        self.log.info("Chunked generation without mocktime")
+        self.nodes[0].reset_mocktime()
+        self.check_generate(25, chunk=8)
+
+        self.log.info("Chunked generation with mocktime")
+        self.nodes[0].set_mocktime(int(time.time()))
+        self.check_generate(40, chunk=7)
+
+        self.log.info("A chunk larger than the number of blocks")
+        self.check_generate(3, chunk=10)
+
+        self.log.info("One-at-a-time generation continues from the chunked chain")
+        self.check_generate(5, chunk=1)
+
+
+if __name__ == '__main__':
+    GenerateChunkTest().main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# Copyright (c) DeFi Blockchain Developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+"""Test many P2PLightPeer connections to one node.
+
+Open a few hundred light peers with add_p2p_connections(), sync each of them
+with a ping, check that every peer receives the inv of a new block and that
+the messages they don't deserialize are only counted, then disconnect them.
+"""
+
+import time
+
+from test_framework.messages import MSG_BLOCK
+from test_framework.mininode import P2PLightPeer
+from test_framework.test_framework import DefiTestFramework
+from test_framework.util import assert_equal, wait_until
+
+NUM_PEERS = 200
+
+
+class P2PManyPeersTest(DefiTestFramework):
+    def set_test_params(self):
+        self.num_nodes = 1
+        self.extra_args = [["-maxconnections={}".format(NUM_PEERS + 25)]]
+
+    def run_test(self):
+        node = self.nodes[0]
+
+        self.log.info("Open {} light peers and complete their version handshakes".format(NUM_PEERS))
+        start = time.time()
+        peers = node.add_p2p_connections([P2PLightPeer(commands=["inv"]) for _ in range(NUM_PEERS)])
+        self.log.info("Connected in {:.1f}s".format(time.time() - start))
+        assert_equal(len(node.getpeerinfo()), NUM_PEERS)
+
+        self.log.info("Sync every peer with a ping")
+        for peer in peers:
+            peer.sync_with_ping()
+
+        self.log.info("Every peer receives the inv of a new block")
+        tip = int(node.generate(1)[0], 16)
+
+        def announced(peer):
+            inv = peer.last_message.get("inv")
+            return inv is not None and any(i.type == MSG_BLOCK and i.hash == tip for i in inv.inv)
+        for peer in peers:
+            wait_until(lambda: announced(peer), timeout=60, lock=peer.lock)
+
+        self.log.info("Messages that are not deserialized are only counted")
+        for peer in peers:
+            with peer.lock:
+                assert peer.message_count["inv"] >= 1
+                for command in peer.message_count:
+                    if command.encode('ascii') not in peer.commands:
+                        assert command not in peer.last_message, command
+
+        self.log.info("Disconnect all peers")
+        node.disconnect_p2ps()
+        for peer in peers:
+            peer.wait_for_disconnect()
+        wait_until(lambda: len(node.getpeerinfo()) == 0, timeout=60)
+
+
+if __name__ == '__main__':
+    P2PManyPeersTest().main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# Copyright (c) DeFi Blockchain Developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+"""Test P2PTrafficGenerator.
+
+Send blocks and transactions to a node both unsolicited and announced (blocks
+with headers, transactions with inv), and check that the node requests the
+announced items and accepts all of them.
+"""
+
+from test_framework.blocktools import create_block, create_coinbase
+from test_framework.messages import COutPoint, CTransaction, CTxIn, CTxOut
+from test_framework.mininode import mininode_lock, P2PTrafficGenerator
+from test_framework.script import CScript, OP_TRUE
+from test_framework.test_framework import DefiTestFramework
+from test_framework.util import (
+    assert_equal,
+    assert_greater_than_or_equal,
+)
+
+
+class P2PTrafficGeneratorTest(DefiTestFramework):
+    def set_test_params(self):
+        self.num_nodes = 1
+        self.setup_clean_chain = True
+        self.extra_args = [["-whitelist=127.0.0.1", "-dummypos=1", "-acceptnonstdtxn=1"]]
+
+    def make_blocks(self, count):
+        """Return count blocks with anyone-can-spend coinbases on top of the node's tip."""
+        tip = self.nodes[0].getblock(self.nodes[0].getbestblockhash())
+        prev = int(tip['hash'], 16)
+        blocks = []
+        for i in range(count):
+            block = create_block(prev, create_coinbase(tip['height'] + 1 + i), tip['time'] + 1 + i)
+            block.solve()
+            blocks.append(block)
+            prev = block.sha256
+        return blocks
+
+    def make_txs(self, blocks):
+        """Return one transaction spending the coinbase of each block."""
+        txs = []
+        for block in blocks:
+            coinbase = block.vtx[0]
+            tx = CTransaction()
+            tx.vin.append(CTxIn(COutPoint(coinbase.sha256, 0)))
+            tx.vout.append(CTxOut(coinbase.vout[0].nValue - 10000, CScript([OP_TRUE])))
+            tx.calc_sha256()
+            txs.append(tx)
+        return txs
+
+    def run_test(self):
+        node = self.nodes[0]
+        p2p = node.add_p2p_connection(P2PTrafficGenerator())
+
+        self.log.info("Send blocks unsolicited")
+        blocks = self.make_blocks(20)
+        stats = p2p.send_traffic(p2p.prepare_blocks(blocks))
+        assert_equal(stats['messages'], 20)
+        assert_equal(node.getbestblockhash(), blocks[-1].hash)
+
+        self.log.info("Announce blocks with headers and send them when the node requests them")
+        announced_blocks = self.make_blocks(40)
+        stats = p2p.send_traffic(p2p.prepare_blocks(announced_blocks), announce=True, batch_size=15)
+        # Three headers messages of up to 15 headers each
+        assert_equal(stats['messages'], 3)
+        assert_equal(node.getbestblockhash(), announced_blocks[-1].hash)
+        assert 'getdata_latency' in stats
+        # Only the requests for this traffic are kept
+        with mininode_lock:
+            assert_equal(set(p2p.getdata_requests), set(block.sha256 for block in announced_blocks))
+
+        self.log.info("Mature the coinbases")
+        node.generate(100)
+
+        self.log.info("Send transactions unsolicited")
+        txs = self.make_txs(blocks[:10])
+        p2p.send_traffic(p2p.prepare_txs(txs))
+        assert set(tx.hash for tx in txs).issubset(node.getrawmempool())
+
+        self.log.info("Announce transactions with inv and send them when the node requests them")
+        txs = self.make_txs(blocks[10:])
+        stats = p2p.send_traffic(p2p.prepare_txs(txs), announce=True)
+        assert_equal(stats['messages'], 1)
+        assert set(tx.hash for tx in txs).issubset(node.getrawmempool())
+
+        self.log.info("Limit the send rate")
+        txs = self.make_txs(announced_blocks[:10])
+        stats = p2p.send_traffic(p2p.prepare_txs(txs), rate=20, batch_size=1)
+        # The last of 10 messages at 20 per second is written 0.45 seconds after the first
+        assert_greater_than_or_equal(stats['send_seconds'], 0.4)
+        assert set(tx.hash for tx in txs).issubset(node.getrawmempool())
+
+
+if __name__ == '__main__':
+    P2PTrafficGeneratorTest().main()
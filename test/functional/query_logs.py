@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# Copyright (c) DeFi Blockchain Developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+"""Query the logs of a test directory through an index.
+
+The first query (and any query after a log changed) writes an index of the
+test_framework.log and node*/<chain>/debug.log files to <testdir>/log_index/.
+For every log event it holds the timestamp, the offset and length of the event
+in the log, the thread name (from -logthreadnames) and the category: for node
+logs the tag at the start of the message, usually the logging function (e.g.
+UpdateTip), for the test framework log the logger name (e.g. TestFramework.node0).
+
+Queries then only read the matching events from the logs, e.g. all UpdateTip
+lines across nodes between two times:
+
+    query_logs.py <testdir> --category UpdateTip --since 2021-06-01T12:00:02 --until 2021-06-01T12:00:04
+
+If no argument is provided, the most recent test directory will be used."""
+
+import argparse
+from array import array
+from bisect import bisect_left
+import calendar
+from collections import Counter, defaultdict, namedtuple
+import heapq
+import itertools
+import json
+import mmap
+import os
+import re
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+# N.B.: don't import any local modules other than combine_logs here - this script
+# must remain executable without the parent module installed.
+from combine_logs import (
+    TIMESTAMP_PATTERN_BYTES,
+    find_latest_test_dir,
+    get_log_files,
+    make_log_event,
+    print_logs_html,
+    print_logs_plain,
+    scan_events,
+)
+
+INDEX_DIR = "log_index"
+INDEX_VERSION = 2
+
+# Thread name following the timestamp of an event, e.g. " [msghand]" in debug.log
+EVENT_THREAD_PATTERN = re.compile(rb" \[([^\]\n]*)\]")
+# Category following the timestamp (and thread name) of an event, e.g.
+# " UpdateTip: " in debug.log or " TestFramework.node0 (DEBUG): " in test_framework.log
+EVENT_CATEGORY_PATTERN = re.compile(rb" ([A-Za-z_][\w.:]*)(?: \([A-Z]+\))?: ")
+# A log timestamp or a prefix of one
+TIMESTAMP_PREFIX_PATTERN = re.compile(r"^\d{4}(-\d{2}(-\d{2}(T\d{2}(:\d{2}(:\d{2}(\.\d{1,6})?)?)?)?)?)?Z?$")
+TIMESTAMP_FILL = "1970-01-01T00:00:00.000000"
+
+# Columns of the index, one entry per log event, in the order they are stored
+INDEX_COLUMNS = [
+    ('timestamps', 'q'),  # microseconds since the epoch
+    ('offsets', 'Q'),
+    ('lengths', 'I'),
+    ('threads', 'I'),  # index into thread_names
+    ('categories', 'I'),  # index into category_names
+]
+
+LogIndex = namedtuple('LogIndex', [name for name, _ in INDEX_COLUMNS] + ['thread_names', 'category_names'])
+
+
+def main():
+    """Main function. Parses args, loads or builds the index and prints the matching events."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument(
+        'testdir', nargs='?', default='',
+        help=('temporary test directory to query the logs of. '
+              'Defaults to the most recent'))
+    parser.add_argument('--since', help='only output events at or after this time (e.g. 2021-06-01T12:00:05, a prefix of the log timestamps is enough)')
+    parser.add_argument('--until', help='only output events before this time')
+    parser.add_argument('--source', help='only output events from these comma-separated sources (e.g. test,node1)')
+    parser.add_argument('--thread', help='only output events logged by these comma-separated threads (e.g. msghand,httpworker.0)')
+    parser.add_argument('--category', help='only output events of these comma-separated categories (e.g. UpdateTip,TestFramework.node0)')
+    parser.add_argument('--grep', help='only output events matching this regular expression')
+    parser.add_argument('--summary', action='store_true', help='print the number of events per source, thread and category instead of the events')
+    parser.add_argument('-c', '--color', dest='color', action='store_true', help='outputs the events colored by source (requires posix terminal colors. Use less -r for viewing)')
+    parser.add_argument('--html', dest='html', action='store_true', help='outputs one page of the events as html. Requires jinja2. pip install jinja2')
+    parser.add_argument('--page', type=int, default=1, help='page of the events to output with --html (default: %(default)s)')
+    parser.add_argument('--pagesize', type=int, default=1000, help='number of events per page with --html (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.html and args.color:
+        parser.error("Only one out of --color or --html should be specified")
+    if args.page < 1 or args.pagesize < 1:
+        parser.error("--page and --pagesize must be positive")
+    try:
+        since = parse_timestamp(args.since) if args.since else None
+        until = parse_timestamp(args.until) if args.until else None
+        pattern = re.compile(args.grep) if args.grep else None
+    except (ValueError, re.error) as e:
+        parser.error(str(e))
+
+    testdir = args.testdir or find_latest_test_dir()
+
+    if not testdir:
+        print("No test directories found")
+        sys.exit(1)
+
+    if not args.testdir:
+        print("Opening latest test directory: {}".format(testdir), file=sys.stderr)
+
+    files = get_log_files(testdir)
+    if args.source:
+        files = [(source, f) for source, f in files if source in args.source.split(',')]
+    files = [(source, f) for source, f in files if os.path.isfile(f)]
+
+    start_time = time.time()
+    indexes = {source: load_index(testdir, source, f) for source, f in files}
+    print("Loaded index in {:.3f}s".format(time.time() - start_time), file=sys.stderr)
+
+    threads = args.thread.split(',') if args.thread else None
+    categories = args.category.split(',') if args.category else None
+
+    if args.summary:
+        print_summary(files, indexes, since=since, until=until, threads=threads, categories=categories)
+        return
+
+    log_events = heapq.merge(*[query_log(source, f, indexes[source], since=since, until=until, threads=threads, categories=categories, pattern=pattern) for source, f in files])
+
+    if args.html:
+        page = itertools.islice(log_events, (args.page - 1) * args.pagesize, args.page * args.pagesize)
+        print_logs_html(page, title="Logs from testcase, page {}".format(args.page))
+    else:
+        colors = defaultdict(lambda: '')
+        if args.color:
+            colors["test"] = "\033[0;36m"  # CYAN
+            colors["node0"] = "\033[0;34m"  # BLUE
+            colors["node1"] = "\033[0;32m"  # GREEN
+            colors["node2"] = "\033[0;31m"  # RED
+            colors["node3"] = "\033[0;33m"  # YELLOW
+            colors["reset"] = "\033[0m"  # Reset font color
+        print_logs_plain(log_events, colors)
+
+
+def parse_timestamp(timestamp):
+    """Return the microseconds since the epoch of a log timestamp, or of a prefix of one (e.g. 2021-06-01T12:00)."""
+    if not TIMESTAMP_PREFIX_PATTERN.match(timestamp):
+        raise ValueError("Invalid timestamp {}, expected e.g. 2021-06-01T12:00:05".format(timestamp))
+    timestamp = timestamp.rstrip('Z')
+    timestamp += TIMESTAMP_FILL[len(timestamp):]
+    seconds = calendar.timegm(time.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S'))
+    return seconds * 1000000 + int(timestamp[20:26])
+
+
+def build_index(logfile):
+    """Scan a log and return its LogIndex."""
+    columns = {name: array(typecode) for name, typecode in INDEX_COLUMNS}
+    thread_ids = {}
+    category_ids = {}
+    # Seconds since the epoch of the "%Y-%m-%dT%H:%M:%S" part of timestamps
+    seconds = {}
+    with open(logfile, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size:
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                for start, end, time_match in scan_events(buf):
+                    timestamp = time_match.group()
+                    second = timestamp[:19]
+                    if second not in seconds:
+                        seconds[second] = calendar.timegm(time.strptime(second.decode(), '%Y-%m-%dT%H:%M:%S'))
+                    micros = int(timestamp[20:26]) if time_match.group(1) else 0
+                    # Either may be missing, e.g. "[init] Bound to ..." has a thread but no category
+                    thread = EVENT_THREAD_PATTERN.match(buf, time_match.end())
+                    category = EVENT_CATEGORY_PATTERN.match(buf, thread.end() if thread else time_match.end())
+                    thread = thread.group(1) if thread else b''
+                    category = category.group(1) if category else b''
+                    columns['timestamps'].append(seconds[second] * 1000000 + micros)
+                    columns['offsets'].append(start)
+                    columns['lengths'].append(end - start)
+                    columns['threads'].append(thread_ids.setdefault(thread, len(thread_ids)))
+                    columns['categories'].append(category_ids.setdefault(category, len(category_ids)))
+    return LogIndex(thread_names=[t.decode('utf-8', errors='replace') for t in thread_ids],
+                    category_names=[c.decode('utf-8', errors='replace') for c in category_ids],
+                    **columns)
+
+
+def load_index(testdir, source, logfile):
+    """Return the LogIndex of a log, from <testdir>/log_index/ if it is up to date, otherwise build and save it."""
+    index_dir = os.path.join(testdir, INDEX_DIR)
+    meta_file = os.path.join(index_dir, source + ".json")
+    data_file = os.path.join(index_dir, source + ".idx")
+    st = os.stat(logfile)
+    try:
+        with open(meta_file, encoding='utf8') as f:
+            meta = json.load(f)
+        if (meta['version'], meta['size'], meta['mtime_ns']) == (INDEX_VERSION, st.st_size, st.st_mtime_ns):
+            columns = {name: array(typecode) for name, typecode in INDEX_COLUMNS}
+            with open(data_file, 'rb') as f:
+                for name, _ in INDEX_COLUMNS:
+                    columns[name].fromfile(f, meta['count'])
+            return LogIndex(thread_names=meta['thread_names'], category_names=meta['category_names'], **columns)
+    except (OSError, ValueError, KeyError, EOFError):
+        pass
+
+    index = build_index(logfile)
+    os.makedirs(index_dir, exist_ok=True)
+    with open(data_file + ".tmp", 'wb') as f:
+        for name, _ in INDEX_COLUMNS:
+            getattr(index, name).tofile(f)
+    os.replace(data_file + ".tmp", data_file)
+    # The metadata is written last, so an index without it is rebuilt
+    with open(meta_file + ".tmp", 'w', encoding='utf8') as f:
+        json.dump({
+            'version': INDEX_VERSION,
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'count': len(index.timestamps),
+            'thread_names': index.thread_names,
+            'category_names': index.category_names,
+        }, f)
+    os.replace(meta_file + ".tmp", meta_file)
+    return index
+
+
+def select_events(index, *, since=None, until=None, threads=None, categories=None):
+    """Return the positions in the index of the events matching the query."""
+    # Log timestamps only increase, so the time window is a range of the index
+    lo = bisect_left(index.timestamps, since) if since is not None else 0
+    hi = bisect_left(index.timestamps, until) if until is not None else len(index.timestamps)
+    positions = range(lo, hi)
+    if threads is not None:
+        thread_ids = {i for i, name in enumerate(index.thread_names) if name in threads}
+        positions = [i for i in positions if index.threads[i] in thread_ids]
+    if categories is not None:
+        category_ids = {i for i, name in enumerate(index.category_names) if name in categories}
+        positions = [i for i in positions if index.categories[i] in category_ids]
+    return positions
+
+
+def query_log(source, logfile, index, *, pattern=None, **query):
+    """Generator function that returns the log events of a log matching the query."""
+    positions = select_events(index, **query)
+    if not positions:
+        return
+    with open(logfile, 'rb') as infile, mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        for i in positions:
+            offset = index.offsets[i]
+            data = buf[offset:offset + index.lengths[i]]
+            event = make_log_event(source, data, TIMESTAMP_PATTERN_BYTES.match(data).group().decode())
+            if pattern is None or pattern.search(event.event):
+                yield event
+
+
+def print_summary(files, indexes, **query):
+    """Print the number of events matching the query per source, thread and category."""
+    for source, logfile in files:
+        index = indexes[source]
+        positions = select_events(index, **query)
+        print("{} ({}): {} events".format(source, logfile, len(positions)))
+        for title, column, names in [("threads", index.threads, index.thread_names), ("categories", index.categories, index.category_names)]:
+            counts = Counter(column[i] for i in positions)
+            print("  {}:".format(title))
+            for name_id, count in counts.most_common():
+                print("    {: >8} {}".format(count, names[name_id] or '-'))
+
+
+class TestQueryLogs(unittest.TestCase):
+    LOG = ("2021-06-01T12:00:01.000000Z [init] Bound to 127.0.0.1:12000\n"
+           "2021-06-01T12:00:01.500000Z [msghand] UpdateTip: new best=01 height=1\n"
+           "  continued\n"
+           "2021-06-01T12:00:02.000000Z [httpworker.0] ThreadRPCServer method=getblockcount user=__cookie__\n"
+           "2021-06-01T12:00:02.000000Z [msghand] UpdateTip: new best=02 height=2\n"
+           "2021-06-01T12:00:03Z [scheduler] CWallet: wallet updated\n"
+           "2021-06-01T12:00:04.000001Z Shutdown: done\n")
+
+    def write_log(self, tmp_dir, content):
+        logfile = os.path.join(tmp_dir, "debug.log")
+        with open(logfile, 'w', encoding='utf8') as f:
+            f.write(content)
+        return logfile
+
+    def names(self, index, positions):
+        return [(index.thread_names[index.threads[i]], index.category_names[index.categories[i]]) for i in positions]
+
+    def test_parse_timestamp(self):
+        second = calendar.timegm((2021, 6, 1, 12, 0, 5, 0, 0, 0)) * 1000000
+        self.assertEqual(parse_timestamp("2021-06-01T12:00:05.123456Z"), second + 123456)
+        self.assertEqual(parse_timestamp("2021-06-01T12:00:05.123456"), second + 123456)
+        self.assertEqual(parse_timestamp("2021-06-01T12:00:05.5"), second + 500000)
+        self.assertEqual(parse_timestamp("2021-06-01T12:00:05"), second)
+        self.assertEqual(parse_timestamp("2021-06-01T12:00"), second - 5000000)
+        self.assertEqual(parse_timestamp("2021-06-01T12"), second - 5000000)
+        self.assertEqual(parse_timestamp("2021-06-01"), second - 12 * 3600 * 1000000 - 5000000)
+        self.assertEqual(parse_timestamp("2021"), calendar.timegm((2021, 1, 1, 0, 0, 0, 0, 0, 0)) * 1000000)
+        for invalid in ("", "21-06-01", "2021-6-1", "2021-06-01 12:00", "2021-06-01T12:00:05.1234567", "yesterday"):
+            self.assertRaises(ValueError, parse_timestamp, invalid)
+
+    def test_build_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            logfile = self.write_log(tmp_dir, self.LOG)
+            index = build_index(logfile)
+            self.assertEqual(self.names(index, range(len(index.timestamps))), [
+                # A thread without a category
+                ("init", ""),
+                ("msghand", "UpdateTip"),
+                ("httpworker.0", ""),
+                ("msghand", "UpdateTip"),
+                ("scheduler", "CWallet"),
+                # A category without a thread
+                ("", "Shutdown"),
+            ])
+            self.assertEqual(list(index.timestamps), [parse_timestamp(t) for t in (
+                "2021-06-01T12:00:01", "2021-06-01T12:00:01.5", "2021-06-01T12:00:02", "2021-06-01T12:00:02",
+                "2021-06-01T12:00:03", "2021-06-01T12:00:04.000001")])
+            with open(logfile, 'rb') as f:
+                data = f.read()
+            self.assertEqual(data[index.offsets[1]:index.offsets[1] + index.lengths[1]],
+                             b"2021-06-01T12:00:01.500000Z [msghand] UpdateTip: new best=01 height=1\n  continued\n")
+
+            # The test framework log
+            logfile = self.write_log(tmp_dir, "2021-06-01T12:00:00.000000Z TestFramework.node0 (DEBUG): defid started\n")
+            index = build_index(logfile)
+            self.assertEqual(self.names(index, [0]), [("", "TestFramework.node0")])
+
+            self.assertEqual(len(build_index(self.write_log(tmp_dir, "")).timestamps), 0)
+
+    def test_load_index(self):
+        module = sys.modules[__name__]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            logfile = self.write_log(tmp_dir, self.LOG)
+            index = load_index(tmp_dir, "node0", logfile)
+            self.assertEqual(index, build_index(logfile))
+            self.assertTrue(os.path.isfile(os.path.join(tmp_dir, INDEX_DIR, "node0.json")))
+
+            # An up to date index is loaded without scanning the log
+            with mock.patch.object(module, "build_index", side_effect=AssertionError("index rebuilt")):
+                self.assertEqual(load_index(tmp_dir, "node0", logfile), index)
+
+            # A log that grew is indexed again
+            with open(logfile, 'a', encoding='utf8') as f:
+                f.write("2021-06-01T12:00:05.000000Z [shutoff] Shutdown: done\n")
+            index = load_index(tmp_dir, "node0", logfile)
+            self.assertEqual(len(index.timestamps), 7)
+            self.assertEqual(self.names(index, [6]), [("shutoff", "Shutdown")])
+
+            # So is a log changed in place, with the same size
+            st = os.stat(logfile)
+            with open(logfile, 'r+', encoding='utf8') as f:
+                f.write(self.LOG.replace("[init]", "[main]", 1))
+            os.utime(logfile, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+            self.assertEqual(os.stat(logfile).st_size, st.st_size)
+            index = load_index(tmp_dir, "node0", logfile)
+            self.assertEqual(self.names(index, [0]), [("main", "")])
+
+            # A damaged index is rebuilt
+            with open(os.path.join(tmp_dir, INDEX_DIR, "node0.idx"), 'wb') as f:
+                f.write(b"\x00")
+            self.assertEqual(load_index(tmp_dir, "node0", logfile), build_index(logfile))
+
+    def test_select_events(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index = build_index(self.write_log(tmp_dir, self.LOG))
+        self.assertEqual(list(select_events(index)), list(range(6)))
+        self.assertEqual(list(select_events(index, threads=["msghand"])), [1, 3])
+        self.assertEqual(list(select_events(index, threads=["init", "httpworker.0"])), [0, 2])
+        self.assertEqual(list(select_events(index, categories=["UpdateTip", "Shutdown"])), [1, 3, 5])
+        self.assertEqual(list(select_events(index, threads=["msghand"], categories=["CWallet"])), [])
+        self.assertEqual(list(select_events(index, threads=["unknown"])), [])
+        # since is inclusive, until exclusive
+        self.assertEqual(list(select_events(index, since=parse_timestamp("2021-06-01T12:00:02"))), [2, 3, 4, 5])
+        self.assertEqual(list(select_events(index, until=parse_timestamp("2021-06-01T12:00:02"))), [0, 1])
+        self.assertEqual(list(select_events(index, since=parse_timestamp("2021-06-01T12:00:01.5"), until=parse_timestamp("2021-06-01T12:00:03"),
+                                            threads=["msghand"])), [1, 3])
+        self.assertEqual(list(select_events(index, since=parse_timestamp("2021-06-02"))), [])
+
+
+if __name__ == '__main__':
+    main()
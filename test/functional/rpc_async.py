@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# Copyright (c) DeFi Blockchain Developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+"""Test the asyncio RPC proxy returned by TestNode.get_async_rpc().
+
+Await concurrent calls on the network thread's event loop and check that
+they return the same results as the synchronous proxy, that errors raise
+JSONRPCException and that calls of a proxy are logged for RPC coverage.
+"""
+
+import asyncio
+
+from test_framework.authproxy import JSONRPCException
+from test_framework.coverage import get_filename
+from test_framework.mininode import NetworkThread
+from test_framework.test_framework import DefiTestFramework
+from test_framework.util import assert_equal
+
+
+class RPCAsyncTest(DefiTestFramework):
+    def set_test_params(self):
+        self.num_nodes = 1
+
+    def run_test(self):
+        node = self.nodes[0]
+        height = node.getblockcount()
+        hashes = [node.getblockhash(h) for h in range(height + 1)]
+        rpc = node.get_async_rpc()
+
+        self.log.info("Concurrent calls return the results of the synchronous proxy")
+
+        async def get_hashes():
+            return await asyncio.gather(*[rpc.getblockhash(h) for h in range(height + 1)])
+        assert_equal(NetworkThread.run_coroutine(get_hashes()), hashes)
+
+        async def get_headers():
+            return await asyncio.gather(*[rpc.getblockheader(blockhash) for blockhash in hashes])
+        assert_equal(NetworkThread.run_coroutine(get_headers()), [node.getblockheader(blockhash) for blockhash in hashes])
+
+        self.log.info("A failing call raises JSONRPCException, the other calls still return")
+
+        async def get_hashes_and_error():
+            results = await asyncio.gather(rpc.getblockhash(0), rpc.getblockhash(height + 1), rpc.getblockhash(height),
+                                           return_exceptions=True)
+            return results[0], results[1], results[2]
+        first, error, last = NetworkThread.run_coroutine(get_hashes_and_error())
+        assert_equal((first, last), (hashes[0], hashes[height]))
+        assert isinstance(error, JSONRPCException)
+        assert_equal(error.error['code'], -8)
+        assert_equal(error.error['message'], "Block height out of range")
+
+        if node.coverage_dir:
+            self.log.info("Calls of the async proxy are logged for RPC coverage")
+            coverage_file = get_filename(node.coverage_dir, node.index)
+            with open(coverage_file, encoding='utf8') as f:
+                logged = f.read().split()
+
+            async def get_count():
+                return await rpc.getblockcount()
+            assert_equal(NetworkThread.run_coroutine(get_count()), height)
+            with open(coverage_file, encoding='utf8') as f:
+                assert_equal(f.read().split(), logged + ['getblockcount'])
+
+        NetworkThread.run_coroutine(rpc.close())
+
+
+if __name__ == '__main__':
+    RPCAsyncTest().main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Copyright (c) DeFi Blockchain Developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+"""Test call_many() over a pool of pipelined keep-alive RPC connections.
+
+defid reads the next request from a connection only after it answered the
+previous one, so pipelined requests are processed one at a time per
+connection. Check that the results still come back in request order, with
+several connections, several threads and failing calls.
+"""
+
+import threading
+
+from test_framework.authproxy import JSONRPCException
+from test_framework.test_framework import DefiTestFramework
+from test_framework.util import (
+    assert_equal,
+    assert_raises_rpc_error,
+    get_rpc_proxy,
+)
+
+
+class RPCPipeliningTest(DefiTestFramework):
+    def set_test_params(self):
+        self.num_nodes = 1
+
+    def run_test(self):
+        node = self.nodes[0]
+        height = node.getblockcount()
+        hashes = [node.getblockhash(h) for h in range(height + 1)]
+        proxy = get_rpc_proxy(node.url, 0, timeout=node.rpc_timeout, coveragedir=node.coverage_dir, pool_size=3)
+
+        self.log.info("Results of pipelined calls come back in request order")
+        assert_equal(proxy.call_many([proxy.getblockhash.get_request(h) for h in range(height + 1)]), hashes)
+
+        self.log.info("Mixed methods in one call_many()")
+        requests = []
+        for h in range(0, height + 1, 7):
+            requests.append(proxy.getblockhash.get_request(h))
+            requests.append(proxy.getblockheader.get_request(hashes[h]))
+        results = proxy.call_many(requests)
+        for i, h in enumerate(range(0, height + 1, 7)):
+            assert_equal(results[2 * i], hashes[h])
+            assert_equal(results[2 * i + 1]['height'], h)
+
+        self.log.info("A failing call raises, and the pool keeps working")
+        requests = [proxy.getblockhash.get_request(h) for h in range(10)]
+        requests[5] = proxy.getblockhash.get_request(height + 100)
+        assert_raises_rpc_error(-8, "Block height out of range", proxy.call_many, requests)
+        assert_equal(proxy.call_many([proxy.getblockhash.get_request(h) for h in range(10)]), hashes[:10])
+
+        self.log.info("Concurrent call_many() from several threads share the pool")
+        errors = []
+
+        def worker(offset):
+            try:
+                heights = [(offset + 13 * i) % (height + 1) for i in range(50)]
+                assert_equal(proxy.call_many([proxy.getblockhash.get_request(h) for h in heights]), [hashes[h] for h in heights])
+            except (AssertionError, JSONRPCException) as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(offset,)) for offset in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(errors, [])
+
+
+if __name__ == '__main__':
+    RPCPipeliningTest().main()
@@ -8,11 +8,44 @@ Provides a way to track which RPC commands are exercised during
 testing.
 """
 
+import contextlib
+import functools
 import os
+import threading
+
+from .authproxy import IDEMPOTENT_RPCS, RPCBatch
 
 
 REFERENCE_FILENAME = 'rpc_interface.txt'
 
+# Calls made by this thread inside untracked_calls() are not logged
+_untracked = threading.local()
+
+
+@contextlib.contextmanager
+def untracked_calls():
+    """
+    Don't log the RPC calls made by the current thread in this block.
+
+    Used by framework helpers such as sync_blocks(), whose calls would
+    otherwise show up as covered by every test that syncs nodes.
+    """
+    depth = getattr(_untracked, 'depth', 0)
+    _untracked.depth = depth + 1
+    try:
+        yield
+    finally:
+        _untracked.depth = depth
+
+
+def untracked_function(func):
+    """Decorator that runs func inside untracked_calls()."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with untracked_calls():
+            return func(*args, **kwargs)
+    return wrapper
+
 
 class AuthServiceProxyWrapper():
     """
@@ -36,7 +69,7 @@ class AuthServiceProxyWrapper():
         if not isinstance(return_val, type(self.auth_service_proxy_instance)):
             # If proxy getattr returned an unwrapped value, do the same here.
             return return_val
-        return AuthServiceProxyWrapper(return_val, self.coverage_logfile)
+        return type(self)(return_val, self.coverage_logfile)
 
     def __call__(self, *args, **kwargs):
         """
@@ -51,18 +84,38 @@ class AuthServiceProxyWrapper():
     def _log_call(self):
         rpc_method = self.auth_service_proxy_instance._service_name
 
-        if self.coverage_logfile:
+        if self.coverage_logfile and not getattr(_untracked, 'depth', 0):
             with open(self.coverage_logfile, 'a+', encoding='utf8') as f:
                 f.write("%s\n" % rpc_method)
 
     def __truediv__(self, relative_uri):
-        return AuthServiceProxyWrapper(self.auth_service_proxy_instance / relative_uri,
-                                       self.coverage_logfile)
+        return type(self)(self.auth_service_proxy_instance / relative_uri,
+                          self.coverage_logfile)
 
     def get_request(self, *args, **kwargs):
         self._log_call()
         return self.auth_service_proxy_instance.get_request(*args, **kwargs)
 
+    def batched(self, idempotent=IDEMPOTENT_RPCS):
+        # Build the batch on the wrapper so that queued calls are logged too
+        return RPCBatch(self, idempotent)
+
+
+class AsyncAuthServiceProxyWrapper(AuthServiceProxyWrapper):
+    """
+    An object that wraps AsyncAuthServiceProxy to record specific RPC calls.
+
+    """
+    async def __call__(self, *args, **kwargs):
+        """
+        Awaits the AsyncAuthServiceProxy call, then writes the particular RPC
+        method called to a file.
+
+        """
+        return_val = await self.auth_service_proxy_instance.__call__(*args, **kwargs)
+        self._log_call()
+        return return_val
+
 def get_filename(dirname, n_node):
     """
     Get a filename unique to the test process ID and node.
@@ -26,6 +26,7 @@ import random
 import socket
 import struct
 import time
+import unittest
 
 from test_framework.siphash import siphash256
 from test_framework.util import hex_str_to_bytes, assert_equal
@@ -99,11 +100,7 @@ def deser_uint256(f):
 
 
 def ser_uint256(u):
-    rs = b""
-    for i in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    return (u & ((1 << 256) - 1)).to_bytes(32, "little")
 
 
 def uint256_from_str(s):
@@ -134,13 +131,9 @@ def deser_vector(f, c):
 # entries in the vector (we use this for serializing the vector of transactions
 # for a witness block).
 def ser_vector(l, ser_function_name=None):
-    r = ser_compact_size(len(l))
-    for i in l:
-        if ser_function_name:
-            r += getattr(i, ser_function_name)()
-        else:
-            r += i.serialize()
-    return r
+    if ser_function_name:
+        return ser_compact_size(len(l)) + b"".join(getattr(i, ser_function_name)() for i in l)
+    return ser_compact_size(len(l)) + b"".join(i.serialize() for i in l)
 
 
 def deser_uint256_vector(f):
@@ -498,35 +491,34 @@ class CTransaction:
         self.hash = None
 
     def serialize_without_witness(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
-        return r
+        return b"".join([
+            struct.pack("<i", self.nVersion),
+            ser_vector(self.vin),
+            ser_vector(self.vout),
+            struct.pack("<I", self.nLockTime),
+        ])
 
     # Only serialize with witness when explicitly called for
     def serialize_with_witness(self):
         flags = 0
         if not self.wit.is_null():
             flags |= 1
-        r = b""
-        r += struct.pack("<i", self.nVersion)
+        r = [struct.pack("<i", self.nVersion)]
         if flags:
             dummy = []
-            r += ser_vector(dummy)
-            r += struct.pack("<B", flags)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
+            r.append(ser_vector(dummy))
+            r.append(struct.pack("<B", flags))
+        r.append(ser_vector(self.vin))
+        r.append(ser_vector(self.vout))
         if flags & 1:
             if (len(self.wit.vtxinwit) != len(self.vin)):
                 # vtxinwit must have the same length as vin
                 self.wit.vtxinwit = self.wit.vtxinwit[:len(self.vin)]
                 for i in range(len(self.wit.vtxinwit), len(self.vin)):
                     self.wit.vtxinwit.append(CTxInWitness())
-            r += self.wit.serialize()
-        r += struct.pack("<I", self.nLockTime)
-        return r
+            r.append(self.wit.serialize())
+        r.append(struct.pack("<I", self.nLockTime))
+        return b"".join(r)
 
     # Regular serialization is with witness -- must explicitly
     # call serialize_without_witness to exclude witness data.
@@ -546,9 +538,11 @@ class CTransaction:
             # Don't cache the result, just return it
             return uint256_from_str(hash256(self.serialize_with_witness()))
 
+        # Serialize and hash once for both
+        txid = hash256(self.serialize_without_witness())
         if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize_without_witness()))
-        self.hash = encode(hash256(self.serialize_without_witness())[::-1], 'hex_codec').decode('ascii')
+            self.sha256 = uint256_from_str(txid)
+        self.hash = encode(txid[::-1], 'hex_codec').decode('ascii')
 
     def is_valid(self):
         self.calc_sha256()
@@ -564,7 +558,12 @@ class CTransaction:
 
 class CBlockHeader:
     __slots__ = ("hash", "hashMerkleRoot", "hashPrevBlock", "nBits", "stakeModifier", "nHeight", "nMintedBlocks", "sig",
-                 "nTime", "nVersion", "sha256")
+                 "nTime", "nVersion", "sha256", "_serialized")
+
+    # The fields serialized in the header. Setting any of them drops the cached
+    # serialization (all of them are immutable, so they can't change otherwise).
+    SERIALIZED_FIELDS = frozenset(["nVersion", "hashPrevBlock", "hashMerkleRoot", "nTime", "nBits",
+                                   "stakeModifier", "nHeight", "nMintedBlocks", "sig"])
 
     def __init__(self, header=None):
         if header is None:
@@ -615,37 +614,32 @@ class CBlockHeader:
         self.sha256 = None
         self.hash = None
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256(self.hashPrevBlock)
-        r += ser_uint256(self.hashMerkleRoot)
-        r += struct.pack("<I", self.nTime)
-        r += struct.pack("<I", self.nBits)
-
-        r += ser_uint256(self.stakeModifier)
-        r += struct.pack("<Q", self.nHeight)
-        r += struct.pack("<Q", self.nMintedBlocks)
-        r += ser_string(self.sig)
+    def __setattr__(self, name, value):
+        if name in CBlockHeader.SERIALIZED_FIELDS:
+            object.__setattr__(self, "_serialized", None)
+        object.__setattr__(self, name, value)
 
-        return r
+    def serialize(self):
+        if self._serialized is None:
+            self._serialized = b"".join([
+                struct.pack("<i", self.nVersion),
+                ser_uint256(self.hashPrevBlock),
+                ser_uint256(self.hashMerkleRoot),
+                struct.pack("<I", self.nTime),
+                struct.pack("<I", self.nBits),
+
+                ser_uint256(self.stakeModifier),
+                struct.pack("<Q", self.nHeight),
+                struct.pack("<Q", self.nMintedBlocks),
+                ser_string(self.sig),
+            ])
+        return self._serialized
 
     def calc_sha256(self):
         if self.sha256 is None:
-            r = b""
-            r += struct.pack("<i", self.nVersion)
-            r += ser_uint256(self.hashPrevBlock)
-            r += ser_uint256(self.hashMerkleRoot)
-            r += struct.pack("<I", self.nTime)
-            r += struct.pack("<I", self.nBits)
-
-            r += ser_uint256(self.stakeModifier)
-            r += struct.pack("<Q", self.nHeight)
-            r += struct.pack("<Q", self.nMintedBlocks)
-            r += ser_string(self.sig)
-
-            self.sha256 = uint256_from_str(hash256(r))
-            self.hash = encode(hash256(r)[::-1], 'hex_codec').decode('ascii')
+            r = hash256(CBlockHeader.serialize(self))
+            self.sha256 = uint256_from_str(r)
+            self.hash = encode(r[::-1], 'hex_codec').decode('ascii')
 
     def rehash(self):
         self.sha256 = None
@@ -672,13 +666,9 @@ class CBlock(CBlockHeader):
         self.vtx = deser_vector(f, CTransaction)
 
     def serialize(self, with_witness=True):
-        r = b""
-        r += super(CBlock, self).serialize()
         if with_witness:
-            r += ser_vector(self.vtx, "serialize_with_witness")
-        else:
-            r += ser_vector(self.vtx, "serialize_without_witness")
-        return r
+            return super(CBlock, self).serialize() + ser_vector(self.vtx, "serialize_with_witness")
+        return super(CBlock, self).serialize() + ser_vector(self.vtx, "serialize_without_witness")
 
     # Calculate the merkle root given a vector of transaction hashes
     @classmethod
@@ -694,7 +684,9 @@ class CBlock(CBlockHeader):
     def calc_merkle_root(self):
         hashes = []
         for tx in self.vtx:
-            tx.calc_sha256()
+            # Like the hash of the block, the txid is cached until tx.rehash()
+            if tx.sha256 is None:
+                tx.calc_sha256()
             hashes.append(ser_uint256(tx.sha256))
         return self.get_merkle_root(hashes)
 
@@ -1556,3 +1548,86 @@ class msg_no_witness_blocktxn(msg_blocktxn):
 
     def serialize(self):
         return self.block_transactions.serialize(with_witness=False)
+
+
+class TestFrameworkMessages(unittest.TestCase):
+    # A new value for every field of CBlockHeader.SERIALIZED_FIELDS
+    HEADER_CHANGES = {
+        "nVersion": 2,
+        "hashPrevBlock": 1,
+        "hashMerkleRoot": 2,
+        "nTime": 3,
+        "nBits": 4,
+        "stakeModifier": 5,
+        "nHeight": 6,
+        "nMintedBlocks": 7,
+        "sig": b"1" * 65,
+    }
+
+    def make_block(self):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(1, 0), b"\x51", 0xffffffff))
+        tx.vout.append(CTxOut(100, b"\x51"))
+        block = CBlock()
+        block.nTime = 1579045065
+        block.vtx = [tx]
+        block.hashMerkleRoot = block.calc_merkle_root()
+        block.rehash()
+        return block
+
+    def header_hash(self, header):
+        """Return the hash of header serialized from its fields, without the cached serialization."""
+        return uint256_from_str(hash256(b"".join([
+            struct.pack("<i", header.nVersion),
+            ser_uint256(header.hashPrevBlock),
+            ser_uint256(header.hashMerkleRoot),
+            struct.pack("<I", header.nTime),
+            struct.pack("<I", header.nBits),
+            ser_uint256(header.stakeModifier),
+            struct.pack("<Q", header.nHeight),
+            struct.pack("<Q", header.nMintedBlocks),
+            ser_string(header.sig),
+        ])))
+
+    def check_header_changes(self, make_header):
+        self.assertEqual(set(self.HEADER_CHANGES), CBlockHeader.SERIALIZED_FIELDS)
+        for name, value in self.HEADER_CHANGES.items():
+            header = make_header()
+            old_hash = header.rehash()
+            self.assertEqual(old_hash, self.header_hash(header))
+            setattr(header, name, value)
+            self.assertEqual(header.rehash(), self.header_hash(header))
+            self.assertNotEqual(header.sha256, old_hash)
+            self.assertEqual(header.hash, "%064x" % header.sha256)
+
+    def test_header_hash(self):
+        self.check_header_changes(lambda: CBlockHeader(self.make_block()))
+        self.check_header_changes(self.make_block)
+
+    def test_header_hash_deepcopy(self):
+        block = self.make_block()
+        self.check_header_changes(lambda: copy.deepcopy(block))
+        self.check_header_changes(lambda: copy.deepcopy(CBlockHeader(block)))
+        # Changing the copy leaves the original alone
+        copy.deepcopy(block).nTime += 1
+        self.assertEqual(block.rehash(), self.header_hash(block))
+
+    def test_header_hash_deserialized(self):
+        block = self.make_block()
+        self.check_header_changes(lambda: FromHex(CBlock(), ToHex(block)))
+        self.check_header_changes(lambda: FromHex(CBlockHeader(), CBlockHeader(block).serialize().hex()))
+        self.assertEqual(FromHex(CBlock(), ToHex(block)).rehash(), block.sha256)
+
+    def test_transaction_hash(self):
+        tx = self.make_block().vtx[0]
+        tx.vout[0].nValue += 1
+        tx.vin[0].scriptSig = b"\x52"
+        txid = hash256(tx.serialize_without_witness())
+        # calc_sha256() updates hash, but sha256 stays cached until rehash()
+        tx.calc_sha256()
+        self.assertEqual(tx.hash, txid[::-1].hex())
+        self.assertNotEqual(tx.sha256, uint256_from_str(txid))
+        tx.rehash()
+        self.assertEqual(tx.sha256, uint256_from_str(txid))
+        self.assertEqual(tx.hash, "%064x" % tx.sha256)
+        self.assertEqual(tx.calc_sha256(True), uint256_from_str(hash256(tx.serialize_with_witness())))
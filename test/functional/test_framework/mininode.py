@@ -15,14 +15,25 @@ P2PDataStore: A p2p interface class that keeps a store of transactions and block
               and can respond correctly to getdata and getheaders messages"""
 import asyncio
 from collections import defaultdict
-from io import BytesIO
 import logging
+import random
+import statistics
 import struct
 import sys
 import threading
+import time
+import unittest
+from unittest import mock
 
 from test_framework.messages import (
+    CBlock,
     CBlockHeader,
+    CBlockLocator,
+    CInv,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
     MIN_VERSION_SUPPORTED,
     msg_anchorauth,
     msg_addr,
@@ -53,6 +64,7 @@ from test_framework.messages import (
     msg_version,
     NODE_NETWORK,
     NODE_WITNESS,
+    ser_compact_size,
     sha256,
 )
 from test_framework.util import wait_until
@@ -92,6 +104,29 @@ MAGIC_BYTES = {
     "regtest": b"\xfa\xbf\xb5\xda",   # regtest
 }
 
+# magic bytes, command, payload length, checksum
+MSG_HEADER_SIZE = 4 + 12 + 4 + 4
+# Maximum number of entries in an inv message (MAX_INV_SZ in net_processing.cpp)
+MAX_INV_SIZE = 50000
+# Maximum number of headers in a headers message (MAX_HEADERS_RESULTS in validation.h)
+MAX_HEADERS_RESULTS = 2000
+
+
+class MessageReader:
+    """Minimal file-like object to deserialize a message payload from a memoryview.
+
+    Only the fields read are copied out of the view, not the whole payload."""
+    __slots__ = ('view', 'pos')
+
+    def __init__(self, view):
+        self.view = view
+        self.pos = 0
+
+    def read(self, n=-1):
+        start = self.pos
+        self.pos = len(self.view) if n < 0 else min(start + n, len(self.view))
+        return self.view[start:self.pos].tobytes()
+
 
 class P2PConnection(asyncio.Protocol):
     """A low-level connection object to a node's P2P interface.
@@ -106,6 +141,8 @@ class P2PConnection(asyncio.Protocol):
     This class contains no logic for handing the P2P message payloads. It must be
     sub-classed and the on_message() callback overridden."""
 
+    __slots__ = ('_transport', 'dstaddr', 'dstport', 'on_connection_send_msg', 'recvbuf', 'magic_bytes')
+
     def __init__(self):
         # The underlying transport of the connection.
         # Should only call methods on this from the NetworkThread, c.f. call_soon_threadsafe
@@ -121,7 +158,7 @@ class P2PConnection(asyncio.Protocol):
         self.dstport = dstport
         # The initial message to send after the connection was made:
         self.on_connection_send_msg = None
-        self.recvbuf = b""
+        self.recvbuf = bytearray()
         self.magic_bytes = MAGIC_BYTES[net]
         logger.debug('Connecting to Defi Node: %s:%d' % (self.dstaddr, self.dstport))
 
@@ -153,8 +190,11 @@ class P2PConnection(asyncio.Protocol):
         else:
             logger.debug("Closed connection to: %s:%d" % (self.dstaddr, self.dstport))
         self._transport = None
-        self.recvbuf = b""
+        self.recvbuf = bytearray()
         self.on_close()
+        with mininode_lock:
+            # Wake up wait_for_disconnect()
+            mininode_lock.notify_all()
 
     # Socket read methods
 
@@ -169,36 +209,53 @@ class P2PConnection(asyncio.Protocol):
 
         This method reads data from the buffer in a loop. It deserializes,
         parses and verifies the P2P header, then passes the P2P payload to
-        the on_message callback for processing."""
+        the on_message callback for processing.
+
+        Messages are framed in place: a read cursor advances over the
+        bytearray buffer, payloads are hashed and deserialized from
+        memoryviews of it, and the consumed bytes are dropped from the
+        buffer once, after the loop."""
+        pos = 0
         try:
-            while True:
-                if len(self.recvbuf) < 4:
-                    return
-                if self.recvbuf[:4] != self.magic_bytes:
-                    raise ValueError("magic bytes mismatch: {} != {}".format(repr(self.magic_bytes), repr(self.recvbuf)))
-                if len(self.recvbuf) < 4 + 12 + 4 + 4:
-                    return
-                command = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
-                msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
-                checksum = self.recvbuf[4+12+4:4+12+4+4]
-                if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
-                    return
-                msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
-                th = sha256(msg)
-                h = sha256(th)
-                if checksum != h[:4]:
-                    raise ValueError("got bad checksum " + repr(self.recvbuf))
-                self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
-                if command not in MESSAGEMAP:
-                    raise ValueError("Received unknown command from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, command, repr(msg)))
-                f = BytesIO(msg)
-                t = MESSAGEMAP[command]()
-                t.deserialize(f)
-                self._log_message("receive", t)
-                self.on_message(t)
+            with memoryview(self.recvbuf) as buf:
+                while True:
+                    available = len(buf) - pos
+                    if available < 4:
+                        return
+                    if buf[pos:pos+4] != self.magic_bytes:
+                        raise ValueError("magic bytes mismatch: {} != {}".format(repr(self.magic_bytes), repr(buf[pos:].tobytes())))
+                    if available < MSG_HEADER_SIZE:
+                        return
+                    command = buf[pos+4:pos+4+12].tobytes().split(b"\x00", 1)[0]
+                    msglen = struct.unpack_from("<i", buf, pos+4+12)[0]
+                    checksum = buf[pos+4+12+4:pos+MSG_HEADER_SIZE].tobytes()
+                    if available < MSG_HEADER_SIZE + msglen:
+                        return
+                    with buf[pos+MSG_HEADER_SIZE:pos+MSG_HEADER_SIZE+msglen] as msg:
+                        th = sha256(msg)
+                        h = sha256(th)
+                        if checksum != h[:4]:
+                            raise ValueError("got bad checksum " + repr(buf[pos:].tobytes()))
+                        pos += MSG_HEADER_SIZE + msglen
+                        if command not in MESSAGEMAP:
+                            raise ValueError("Received unknown command from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, command, repr(msg.tobytes())))
+                        if not self.on_message_header(command):
+                            continue
+                        t = MESSAGEMAP[command]()
+                        t.deserialize(MessageReader(msg))
+                    self._log_message("receive", t)
+                    self.on_message(t)
         except Exception as e:
-            logger.exception('Error reading message:', repr(e))
+            logger.exception('Error reading message: %s', repr(e))
             raise
+        finally:
+            # All views of the buffer are released here, so it can be resized
+            del self.recvbuf[:pos]
+
+    def on_message_header(self, command):
+        """Callback for the command of each received P2P message, before its payload is
+        deserialized. Returning False drops the message without deserializing it."""
+        return True
 
     def on_message(self, message):
         """Callback for processing a P2P payload. Must be overridden by derived class."""
@@ -231,8 +288,10 @@ class P2PConnection(asyncio.Protocol):
 
     def build_message(self, message):
         """Build a serialized P2P message"""
-        command = message.command
-        data = message.serialize()
+        return self.build_raw_message(message.command, message.serialize())
+
+    def build_raw_message(self, command, data):
+        """Build a serialized P2P message from its command and serialized payload"""
         tmsg = self.magic_bytes
         tmsg += command
         tmsg += b"\x00" * (12 - len(command))
@@ -309,6 +368,9 @@ class P2PInterface(P2PConnection):
             except:
                 print("ERROR delivering %s (%s)" % (repr(message), sys.exc_info()[0]))
                 raise
+            finally:
+                # Wake up any wait_until() waiting on the message just delivered
+                mininode_lock.notify_all()
 
     # Callback methods. Can be overridden by subclasses in individual test
     # cases to provide custom message handling behaviour.
@@ -458,12 +520,105 @@ class P2PInterface(P2PConnection):
         self.ping_counter += 1
 
 
+class P2PLightPeer(P2PConnection):
+    """A lightweight P2P connection, for simulating hundreds of peers from one test.
+
+    Compared to P2PInterface, this class:
+
+    - keeps its state in slots: the number of messages received per command and
+      the most recent message of each deserialized command
+    - synchronizes with the test thread through its own condition variable
+      (self.lock) instead of the global mininode_lock
+    - only deserializes the commands it was created with, plus the version
+      handshake and pings. Other messages are counted from their header and
+      dropped, and do not wake up waiters on self.lock.
+
+    Subclasses may define on_<command>(message) callbacks for the deserialized
+    commands, which are called with self.lock held. Subclasses should declare
+    __slots__ too."""
+
+    __slots__ = ('commands', 'lock', 'message_count', 'last_message', 'nServices', 'ping_counter')
+
+    # Always deserialized, to complete the version handshake and answer pings
+    HANDSHAKE_COMMANDS = frozenset([b"version", b"verack", b"ping", b"pong"])
+
+    def __init__(self, commands=()):
+        super().__init__()
+        self.commands = self.HANDSHAKE_COMMANDS.union(command.encode('ascii') for command in commands)
+        self.lock = threading.Condition(threading.RLock())
+        self.message_count = defaultdict(int)
+        self.last_message = {}
+        self.nServices = 0
+        self.ping_counter = 1
+
+    def peer_connect(self, *args, services=NODE_NETWORK|NODE_WITNESS, **kwargs):
+        create_conn = super().peer_connect(*args, **kwargs)
+        vt = msg_version()
+        vt.nServices = services
+        vt.addrTo.ip = self.dstaddr
+        vt.addrTo.port = self.dstport
+        vt.addrFrom.ip = "0.0.0.0"
+        vt.addrFrom.port = 0
+        self.on_connection_send_msg = vt  # Will be sent soon after connection_made
+        return create_conn
+
+    def on_message_header(self, command):
+        with self.lock:
+            self.message_count[command.decode('ascii')] += 1
+        return command in self.commands
+
+    def on_message(self, message):
+        command = message.command.decode('ascii')
+        with self.lock:
+            try:
+                self.last_message[command] = message
+                callback = getattr(self, 'on_' + command, None)
+                if callback is not None:
+                    callback(message)
+            finally:
+                self.lock.notify_all()
+
+    def on_open(self):
+        pass
+
+    def on_close(self):
+        with self.lock:
+            # Wake up wait_for_disconnect()
+            self.lock.notify_all()
+
+    def on_ping(self, message):
+        self.send_message(msg_pong(message.nonce))
+
+    def on_version(self, message):
+        assert message.nVersion >= MIN_VERSION_SUPPORTED, "Version {} received. Test framework only supports versions greater than {}".format(message.nVersion, MIN_VERSION_SUPPORTED)
+        self.send_message(msg_verack())
+        self.nServices = message.nServices
+
+    def wait_for_verack(self, timeout=60):
+        wait_until(lambda: "verack" in self.last_message, timeout=timeout, lock=self.lock)
+
+    def wait_for_disconnect(self, timeout=60):
+        wait_until(lambda: not self.is_connected, timeout=timeout, lock=self.lock)
+
+    def sync_with_ping(self, timeout=60):
+        self.send_message(msg_ping(nonce=self.ping_counter))
+
+        def test_function():
+            assert self.is_connected
+            return self.last_message.get("pong") and self.last_message["pong"].nonce == self.ping_counter
+
+        wait_until(test_function, timeout=timeout, lock=self.lock)
+        self.ping_counter += 1
+
+
 # One lock for synchronizing all data access between the network event loop (see
 # NetworkThread below) and the thread running the test logic.  For simplicity,
 # P2PConnection acquires this lock whenever delivering a message to a P2PInterface.
 # This lock should be acquired in the thread running the test logic to synchronize
 # access to any data shared with the P2PInterface or P2PConnection.
-mininode_lock = threading.RLock()
+# It is a condition variable (over an RLock) that is notified after every delivered
+# message, so wait_until(..., lock=mininode_lock) wakes up as soon as one arrives.
+mininode_lock = threading.Condition(threading.RLock())
 
 
 class NetworkThread(threading.Thread):
@@ -480,6 +635,14 @@ class NetworkThread(threading.Thread):
         """Start the network thread."""
         self.network_event_loop.run_forever()
 
+    @classmethod
+    def run_coroutine(cls, coro, timeout=60):
+        """Run a coroutine on the network event loop and return its result.
+
+        Called from the test thread, e.g. to await AsyncAuthServiceProxy calls
+        alongside the P2P connections handled by this loop."""
+        return asyncio.run_coroutine_threadsafe(coro, cls.network_event_loop).result(timeout)
+
     def close(self, timeout=10):
         """Close the connections and network event loop."""
         self.network_event_loop.call_soon_threadsafe(self.network_event_loop.stop)
@@ -501,6 +664,12 @@ class P2PDataStore(P2PInterface):
         # store of txs. key is txid, value is a CTransaction object
         self.tx_store = {}
         self.getdata_requests = []
+        # Height index of the chain ending in last_block_hash, see _update_header_chain():
+        # block hashes from the first stored block of the chain, their heights in that
+        # list and their headers serialized as in a headers message (once first sent)
+        self._header_chain = []
+        self._header_heights = {}
+        self._header_bytes = []
 
     def on_getdata(self, message):
         """Check for the tx/block in our stores and if found, reply with an inv message."""
@@ -514,7 +683,12 @@ class P2PDataStore(P2PInterface):
                 logger.debug('getdata message type {} received.'.format(hex(inv.type)))
 
     def on_getheaders(self, message):
-        """Search back through our block store for the locator, and reply with a headers message if found."""
+        """Search our block store for the locator, and reply with a headers message if found.
+
+        The reply holds the headers from the most recent locator block (or hash_stop,
+        if that is more recent but not the tip) up to the tip, or from the first
+        stored block of the chain if no locator block is part of it, and at most
+        2000 of them."""
 
         locator, hash_stop = message.locator, message.hashstop
 
@@ -522,28 +696,47 @@ class P2PDataStore(P2PInterface):
         if not self.block_store:
             return
 
-        headers_list = [self.block_store[self.last_block_hash]]
-        maxheaders = 2000
-        while headers_list[-1].sha256 not in locator.vHave:
-            # Walk back through the block store, adding headers to headers_list
-            # as we go.
-            prev_block_hash = headers_list[-1].hashPrevBlock
-            if prev_block_hash in self.block_store:
-                prev_block_header = CBlockHeader(self.block_store[prev_block_hash])
-                headers_list.append(prev_block_header)
-                if prev_block_header.sha256 == hash_stop:
-                    # if this is the hashstop header, stop here
-                    break
-            else:
-                logger.debug('block hash {} not found in block store'.format(hex(prev_block_hash)))
-                break
-
-        # Truncate the list if there are too many headers
-        headers_list = headers_list[:-maxheaders - 1:-1]
-        response = msg_headers(headers_list)
-
-        if response is not None:
-            self.send_message(response)
+        self._update_header_chain()
+        tip_height = len(self._header_chain) - 1
+        maxheaders = MAX_HEADERS_RESULTS
+        start = max((self._header_heights[h] for h in locator.vHave if h in self._header_heights), default=0)
+        stop_height = self._header_heights.get(hash_stop)
+        if stop_height is not None and start < stop_height < tip_height:
+            # the hashstop header is reached before the locator, stop there
+            start = stop_height
+
+        headers = self._header_bytes[start:start + maxheaders]
+        for i, header in enumerate(headers):
+            if header is None:
+                # A header in a headers message is followed by an empty transaction count
+                headers[i] = self._header_bytes[start + i] = CBlockHeader(self.block_store[self._header_chain[start + i]]).serialize() + b"\x00"
+        # Log the reply as send_message() would. _log_message() cuts it at 500
+        # characters, which the first two headers always fill
+        logged = self._header_chain[start:start + min(len(headers), 2)]
+        self._log_message("send", msg_headers([CBlockHeader(self.block_store[h]) for h in logged]))
+        self.send_raw_message(self.build_raw_message(msg_headers.command, ser_compact_size(len(headers)) + b"".join(headers)))
+
+    def _update_header_chain(self):
+        """Update the height index of headers to the chain ending in last_block_hash.
+
+        Only the blocks after the fork point with the indexed chain are visited,
+        so extending the tip costs O(new blocks)."""
+        if self._header_chain and self._header_chain[-1] == self.last_block_hash:
+            return
+        new_hashes = []
+        block_hash = self.last_block_hash
+        while block_hash in self.block_store and block_hash not in self._header_heights:
+            new_hashes.append(block_hash)
+            block_hash = self.block_store[block_hash].hashPrevBlock
+        fork_height = self._header_heights[block_hash] + 1 if block_hash in self._header_heights else 0
+        for stale_hash in self._header_chain[fork_height:]:
+            del self._header_heights[stale_hash]
+        del self._header_chain[fork_height:]
+        del self._header_bytes[fork_height:]
+        for block_hash in reversed(new_hashes):
+            self._header_heights[block_hash] = len(self._header_chain)
+            self._header_chain.append(block_hash)
+            self._header_bytes.append(None)
 
     def send_blocks_and_test(self, blocks, node, *, success=True, force_send=False, reject_reason=None, expect_disconnect=False, timeout=60):
         """Send blocks to test node and test whether the tip advances.
@@ -613,3 +806,384 @@ class P2PDataStore(P2PInterface):
                 # Check that none of the txs are now in the mempool
                 for tx in txs:
                     assert tx.hash not in raw_mempool, "{} tx found in mempool".format(tx.hash)
+
+
+class P2PTrafficGenerator(P2PDataStore):
+    """A P2P data store that floods a node with transactions and blocks, for benchmarking.
+
+    Transactions and blocks are serialized once by prepare_txs() and
+    prepare_blocks(). send_traffic() then writes them to the socket from the
+    network thread in batches of one transport.writelines() call each,
+    optionally limited to a rate, and reports the send throughput and how long
+    the node took to process them. getdata requests are answered from the
+    serialized messages, and in announce mode the time from each announcement
+    to the node's getdata for the item is recorded."""
+
+    def __init__(self):
+        super().__init__()
+        # store of serialized messages. key is tx/block hash, value is (inv type, msg_tx/msg_block bytes)
+        self.raw_store = {}
+        # hash -> time its inv was written, until the node requests it
+        self.announce_times = {}
+        self.getdata_latencies = []
+        # Set while the transport's write buffer is below its high-water mark
+        self._can_write = None
+
+    def prepare_txs(self, txs):
+        """Serialize txs and add them to the stores. Returns their hashes, to pass to send_traffic()."""
+        with mininode_lock:
+            for tx in txs:
+                tx.calc_sha256()
+                self.tx_store[tx.sha256] = tx
+                self.raw_store[tx.sha256] = (MSG_TX, self.build_message(msg_tx(tx)))
+        return [tx.sha256 for tx in txs]
+
+    def prepare_blocks(self, blocks):
+        """Serialize blocks and add them to the stores. Returns their hashes, to pass to send_traffic()."""
+        with mininode_lock:
+            for block in blocks:
+                block.calc_sha256()
+                self.block_store[block.sha256] = block
+                self.last_block_hash = block.sha256
+                self.raw_store[block.sha256] = (MSG_BLOCK, self.build_message(msg_block(block)))
+        return [block.sha256 for block in blocks]
+
+    def on_getdata(self, message):
+        """Reply to getdata for prepared items with their serialized messages, in one write."""
+        now = time.time()
+        raw_messages = []
+        others = msg_getdata()
+        for inv in message.inv:
+            announced = self.announce_times.pop(inv.hash, None)
+            if announced is not None:
+                self.getdata_latencies.append(now - announced)
+            if inv.hash in self.raw_store:
+                self.getdata_requests.append(inv.hash)
+                raw_messages.append(self.raw_store[inv.hash][1])
+            else:
+                others.inv.append(inv)
+        if raw_messages and self.is_connected and not self._transport.is_closing():
+            self._transport.writelines(raw_messages)
+        if others.inv:
+            super().on_getdata(others)
+
+    def pause_writing(self):
+        """asyncio callback when the transport's write buffer is over the high-water mark."""
+        if self._can_write is not None:
+            self._can_write.clear()
+
+    def resume_writing(self):
+        """asyncio callback when the transport's write buffer drained below the low-water mark."""
+        if self._can_write is not None:
+            self._can_write.set()
+
+    def send_traffic(self, hashes, *, announce=False, rate=None, batch_size=500, timeout=60):
+        """Send prepared txs/blocks to the node and return throughput statistics.
+
+         - if announce is False: send the tx and block messages unsolicited
+         - if announce is True: announce txs with inv messages and blocks with headers
+           messages (a node answers a block inv with getheaders, not getdata), and
+           send the items when the node requests them. getdata_requests is cleared
+           first, so that only requests for this traffic count
+         - rate: maximum number of messages per second, or None to write as fast as the socket allows
+         - batch_size: number of messages (or announced items) per write
+
+        Returns a dict with the number of messages and bytes written, the seconds it
+        took to write them and the resulting rates, the seconds until the node
+        processed all of them (replied to a ping sent after them) and, if announce
+        is True, the min/median/max seconds from an announcement to the node's getdata."""
+        assert self.is_connected
+        assert batch_size > 0
+        with mininode_lock:
+            items = [self.raw_store[h] for h in hashes]
+            self.getdata_latencies = []
+            if announce:
+                del self.getdata_requests[:]
+                raw_messages = self._build_announcements(hashes, [inv_type for inv_type, _ in items], batch_size)
+                batch_size = 1
+            else:
+                raw_messages = [(None, raw) for _, raw in items]
+
+        start = time.time()
+        stats = NetworkThread.run_coroutine(self._write_batches(raw_messages, rate, batch_size), timeout=timeout)
+        stats['send_seconds'] = time.time() - start
+        if announce:
+            wanted = set(hashes)
+            wait_until(lambda: wanted.issubset(self.getdata_requests), timeout=timeout, lock=mininode_lock)
+        self.sync_with_ping(timeout=timeout)
+        stats['processed_seconds'] = time.time() - start
+
+        stats['messages_per_second'] = stats['messages'] / max(stats['send_seconds'], 1e-6)
+        stats['bytes_per_second'] = stats['bytes'] / max(stats['send_seconds'], 1e-6)
+        with mininode_lock:
+            latencies = list(self.getdata_latencies)
+        if latencies:
+            stats['getdata_latency'] = {'min': min(latencies), 'median': statistics.median(latencies), 'max': max(latencies)}
+        logger.debug("Sent {messages} messages ({bytes} bytes) in {send_seconds:.3f}s, processed after {processed_seconds:.3f}s".format(**stats))
+        return stats
+
+    def _build_announcements(self, hashes, inv_types, batch_size):
+        """Return (announced hashes, message bytes) pairs announcing runs of up to
+        batch_size txs in inv messages and runs of blocks in headers messages."""
+        announcements = []
+        i = 0
+        while i < len(hashes):
+            inv_type = inv_types[i]
+            limit = min(batch_size, MAX_HEADERS_RESULTS if inv_type == MSG_BLOCK else MAX_INV_SIZE)
+            end = i + 1
+            while end < len(hashes) and end - i < limit and inv_types[end] == inv_type:
+                end += 1
+            if inv_type == MSG_BLOCK:
+                message = msg_headers([CBlockHeader(self.block_store[h]) for h in hashes[i:end]])
+            else:
+                message = msg_inv([CInv(t=inv_type, h=h) for h in hashes[i:end]])
+            announcements.append((hashes[i:end], self.build_message(message)))
+            i = end
+        return announcements
+
+    async def _write_batches(self, raw_messages, rate, batch_size):
+        """Coroutine writing (announced hashes, message bytes) pairs on the network thread."""
+        loop = NetworkThread.network_event_loop
+        if self._can_write is None:
+            self._can_write = asyncio.Event()
+            self._can_write.set()
+        start = loop.time()
+        messages = 0
+        nbytes = 0
+        for i in range(0, len(raw_messages), batch_size):
+            if rate:
+                delay = start + messages / rate - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await self._can_write.wait()
+            if not self.is_connected or self._transport.is_closing():
+                break
+            batch = raw_messages[i:i + batch_size]
+            now = time.time()
+            for announced, _ in batch:
+                for h in announced or []:
+                    self.announce_times[h] = now
+            self._transport.writelines([raw for _, raw in batch])
+            messages += len(batch)
+            nbytes += sum(len(raw) for _, raw in batch)
+        return {'messages': messages, 'bytes': nbytes}
+
+
+class _ReceivingConnection(P2PConnection):
+    """A P2PConnection without a socket that keeps the messages passed to data_received()."""
+
+    def __init__(self):
+        super().__init__()
+        self.dstaddr = "127.0.0.1"
+        self.dstport = 0
+        self.recvbuf = bytearray()
+        self.magic_bytes = MAGIC_BYTES["regtest"]
+        self.received = []
+
+    def on_message(self, message):
+        self.received.append(message)
+
+
+class _LightReceiver(P2PLightPeer):
+    """A P2PLightPeer without a socket that keeps the messages it sends and
+    answers its own pings from another thread, like a node would."""
+
+    is_connected = True
+
+    def __init__(self, commands=()):
+        super().__init__(commands)
+        self.dstaddr = "127.0.0.1"
+        self.dstport = 0
+        self.recvbuf = bytearray()
+        self.magic_bytes = MAGIC_BYTES["regtest"]
+        self.sent = []
+
+    def send_message(self, message):
+        self.sent.append(message)
+        if message.command == b"ping":
+            threading.Timer(0.05, self.data_received, [self.build_message(msg_pong(message.nonce))]).start()
+
+
+class _HeadersDataStore(P2PDataStore):
+    """A P2PDataStore without a socket that keeps the raw messages it sends."""
+
+    def __init__(self):
+        super().__init__()
+        self.dstaddr = "127.0.0.1"
+        self.dstport = 0
+        self.magic_bytes = MAGIC_BYTES["regtest"]
+        self.sent = []
+
+    def send_raw_message(self, raw_message_bytes):
+        self.sent.append(raw_message_bytes)
+
+
+def _linear_getheaders(block_store, last_block_hash, message, maxheaders):
+    """Return the headers reply to a getheaders message by walking back from the tip."""
+    locator, hash_stop = message.locator, message.hashstop
+    headers_list = [block_store[last_block_hash]]
+    while headers_list[-1].sha256 not in locator.vHave:
+        prev_block_hash = headers_list[-1].hashPrevBlock
+        if prev_block_hash not in block_store:
+            break
+        headers_list.append(CBlockHeader(block_store[prev_block_hash]))
+        if headers_list[-1].sha256 == hash_stop:
+            break
+    return msg_headers(headers_list[:-maxheaders - 1:-1])
+
+
+class TestFrameworkMininode(unittest.TestCase):
+    def make_messages(self):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(1, 0), b"\x51", 0xffffffff))
+        tx.vout.append(CTxOut(100, b"\x51" * 50))
+        block = CBlock()
+        block.nTime = 1579045065
+        block.vtx = [tx] * 3
+        block.hashMerkleRoot = block.calc_merkle_root()
+        return [msg_verack(), msg_ping(7), msg_inv([CInv(MSG_TX, 5), CInv(MSG_BLOCK, 6)]), msg_tx(tx), msg_headers([CBlockHeader(block)]), msg_block(block)]
+
+    def assert_received(self, conn, messages):
+        self.assertEqual([(m.command, m.serialize()) for m in conn.received], [(m.command, m.serialize()) for m in messages])
+        self.assertEqual(conn.recvbuf, bytearray())
+
+    def test_split_messages(self):
+        # Every message split at every byte, across two reads
+        for message in self.make_messages():
+            data = _ReceivingConnection().build_message(message)
+            for i in range(len(data) + 1):
+                conn = _ReceivingConnection()
+                conn.data_received(data[:i])
+                # Nothing is delivered before the message is complete
+                self.assertEqual(len(conn.received), int(i == len(data)))
+                conn.data_received(data[i:])
+                self.assert_received(conn, [message])
+
+    def test_concatenated_messages(self):
+        messages = self.make_messages()
+        data = b"".join(_ReceivingConnection().build_message(m) for m in messages)
+        # All in one read, byte by byte, and in reads ending in the middle of a message
+        for step in (len(data), 1, 7, 100):
+            conn = _ReceivingConnection()
+            for i in range(0, len(data), step):
+                conn.data_received(data[i:i + step])
+            self.assert_received(conn, messages)
+
+        # An incomplete message stays buffered for the next read
+        conn = _ReceivingConnection()
+        ping = conn.build_message(msg_ping(8))
+        conn.data_received(data + ping[:30])
+        self.assertEqual(len(conn.received), len(messages))
+        self.assertEqual(conn.recvbuf, bytearray(ping[:30]))
+        conn.data_received(ping[30:])
+        self.assert_received(conn, messages + [msg_ping(8)])
+
+    def test_dropped_messages(self):
+        messages = self.make_messages()
+        conn = _ReceivingConnection()
+        conn.on_message_header = lambda command: command != b"tx"
+        conn.data_received(b"".join(conn.build_message(m) for m in messages))
+        self.assert_received(conn, [m for m in messages if m.command != b"tx"])
+
+    def test_invalid_messages(self):
+        message = _ReceivingConnection().build_message(msg_ping(7))
+        for data in (b"\x00" * 4 + message[4:], message[:-1] + b"\x01", message[:4] + b"notacommand\x00" + message[16:]):
+            conn = _ReceivingConnection()
+            with self.assertLogs(logger, level="ERROR"), self.assertRaises(ValueError):
+                conn.data_received(data)
+            self.assertEqual(conn.received, [])
+
+    def check_getheaders(self, store, blocks, rng):
+        """Check on_getheaders() against _linear_getheaders() for random locators and hashstops."""
+        for _ in range(5):
+            message = msg_getheaders()
+            message.locator = CBlockLocator()
+            message.locator.vHave = [rng.choice(blocks).sha256 for _ in range(rng.randrange(4))]
+            if rng.random() < 0.5:
+                message.hashstop = rng.choice(blocks).sha256
+            store.on_getheaders(message)
+            expected = _linear_getheaders(store.block_store, store.last_block_hash, message, MAX_HEADERS_RESULTS)
+            self.assertEqual(store.sent.pop(), store.build_message(expected))
+
+    def test_getheaders_forks(self):
+        rng = random.Random(1)
+        with mock.patch(__name__ + ".MAX_HEADERS_RESULTS", 8):
+            for _ in range(50):
+                store = _HeadersDataStore()
+                blocks = []
+                for i in range(rng.randrange(1, 40)):
+                    block = CBlock()
+                    # Build on one of the last blocks, so the tip moves between forks
+                    block.hashPrevBlock = rng.choice(blocks[-4:]).sha256 if blocks else 0
+                    block.nTime = i
+                    block.rehash()
+                    blocks.append(block)
+                # Blocks may also be stored before their parents
+                stored = blocks[:]
+                if rng.random() < 0.3:
+                    rng.shuffle(stored)
+                for block in stored:
+                    store.block_store[block.sha256] = block
+                    store.last_block_hash = block.sha256
+                    self.check_getheaders(store, blocks, rng)
+
+    def test_light_peer_counts(self):
+        peer = _LightReceiver(commands=["inv"])
+        messages = [msg_version(), msg_verack(), msg_ping(7)] + self.make_messages()
+        peer.data_received(b"".join(peer.build_message(m) for m in messages))
+        # Every message is counted, but only the handshake, pings and inv are deserialized
+        self.assertEqual(dict(peer.message_count), {"version": 1, "verack": 2, "ping": 2, "inv": 1, "tx": 1, "headers": 1, "block": 1})
+        self.assertEqual(sorted(peer.last_message), ["inv", "ping", "verack", "version"])
+        self.assertEqual(peer.last_message["inv"].serialize(), msg_inv([CInv(MSG_TX, 5), CInv(MSG_BLOCK, 6)]).serialize())
+        self.assertEqual(peer.recvbuf, bytearray())
+        self.assertEqual([(m.command, getattr(m, "nonce", None)) for m in peer.sent], [(b"verack", None), (b"pong", 7), (b"pong", 7)])
+
+    def test_light_peer_wakeups(self):
+        # Deserialized messages wake up waiters on the peer's lock, dropped ones don't
+        for message, wakes in ((msg_inv([CInv(MSG_TX, 5)]), True), (msg_headers(), False)):
+            peer = _LightReceiver(commands=["inv"])
+            ready = threading.Event()
+            woken = []
+
+            def wait():
+                with peer.lock:
+                    ready.set()
+                    woken.append(peer.lock.wait(0.5))
+            waiter = threading.Thread(target=wait)
+            waiter.start()
+            ready.wait()
+            # Blocks until the waiter released the lock in wait()
+            peer.data_received(peer.build_message(message))
+            waiter.join()
+            self.assertEqual(woken, [wakes])
+            self.assertEqual(peer.message_count[message.command.decode()], 1)
+
+    def test_light_peer_sync_with_ping(self):
+        peer = _LightReceiver()
+        peer.sync_with_ping(timeout=5)
+        peer.sync_with_ping(timeout=5)
+        self.assertEqual([m.nonce for m in peer.sent], [1, 2])
+        self.assertEqual(peer.last_message["pong"].nonce, 2)
+        self.assertEqual(peer.ping_counter, 3)
+
+    def test_getheaders_logged(self):
+        # The raw headers reply is logged exactly like send_message() logs it
+        store = _HeadersDataStore()
+        for count in (1, 2, 5):
+            prev = 0
+            for i in range(count):
+                block = CBlock()
+                block.hashPrevBlock = prev
+                block.nTime = i
+                block.sig = b""
+                block.rehash()
+                store.block_store[block.sha256] = block
+                store.last_block_hash = prev = block.sha256
+            message = msg_getheaders()
+            with self.assertLogs(logger, level="DEBUG") as logs:
+                store.on_getheaders(message)
+                expected = msg_headers()
+                expected.deserialize(MessageReader(memoryview(store.sent[-1][MSG_HEADER_SIZE:])))
+                store._log_message("send", expected)
+            self.assertEqual(len(logs.output), 2)
+            self.assertEqual(logs.output[0], logs.output[1])
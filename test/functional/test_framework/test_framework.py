@@ -6,18 +6,22 @@
 
 import configparser
 from enum import Enum
+import hashlib
+import inspect
+import json
 import logging
 import argparse
 import os
 import pdb
 import random
+import re
 import shutil
 import sys
 import tempfile
 import time
 
 from .authproxy import JSONRPCException
-from . import coverage
+from . import coverage, timing
 from .test_node import TestNode
 from .mininode import NetworkThread
 from .util import (
@@ -25,10 +29,13 @@ from .util import (
     PortSeed,
     assert_equal,
     check_json_precision,
+    clone_datadir,
+    connect_nodes,
     connect_nodes_bi,
     disconnect_nodes,
     get_datadir_path,
     initialize_datadir,
+    set_node_times,
     sync_blocks,
     sync_mempools,
 )
@@ -45,6 +52,9 @@ TEST_EXIT_SKIPPED = 77
 
 TMPDIR_PREFIX = "defi_func_test_"
 
+# Files in a node's chain directory that are not part of a chain snapshot
+SNAPSHOT_IGNORE = ('debug.log', '.cookie', '.lock', '*.pid')
+
 
 class SkipTest(Exception):
     """This exception is raised to skip a test"""
@@ -132,10 +142,25 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
                             help="profile running nodes with perf for the duration of the test")
         parser.add_argument("--randomseed", type=int,
                             help="set a random seed for deterministically reproducing a previous test run")
+        parser.add_argument("--rpcpoolsize", dest="rpc_pool_size", default=0, type=int,
+                            help="keep this many keep-alive RPC connections per node and pipeline call_many() requests over them (default: %(default)s, single connection)")
+        parser.add_argument("--generatechunk", dest="generate_chunk", default=1, type=int,
+                            help="let generate() mint up to this many blocks per generatetoaddress call (default: %(default)s, one block per call)")
+        parser.add_argument("--clonemode", dest="clone_mode", default="auto", choices=["auto", "copy"],
+                            help="how cached datadirs are cloned into the test's nodes: 'auto' reflinks files where the filesystem supports it and hardlinks immutable LevelDB tables, 'copy' always copies (default: %(default)s)")
+        parser.add_argument("--statsfile", dest="statsfile",
+                            help="Write the number of nodes, their memory use and the time spent per RPC and wait (see timing.py) to this JSON file on exit (used by test_runner.py)")
+        parser.add_argument("--warmnode", dest="warmnode",
+                            help="Datadir of an already running node to use as node 0 instead of starting one (set by test_runner.py --warmnodes for single-node tests)")
+        parser.add_argument("--snapshotdir", dest="snapshotdir",
+                            help="Directory for the chain snapshots of restore_or_build_snapshot() (set by test_runner.py to share them between the tests of a run; default: a directory in the test directory, removed with it)")
+        parser.add_argument("--deferredcleanup", dest="deferredcleanup", default=False, action="store_true",
+                            help="Don't remove the test directory on success, but say in the --statsfile that it can be removed (test_runner.py removes it in the background)")
         self.add_options(parser)
         self.options = parser.parse_args()
 
         PortSeed.n = self.options.port_seed
+        TestNode.GenerateChunk = self.options.generate_chunk
 
         check_json_precision()
 
@@ -228,7 +253,10 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
             success != TestStatus.FAILED and
             not self.options.perf
         )
-        if should_clean_up:
+        if should_clean_up and self.options.deferredcleanup:
+            self.log.info("Leaving the removal of {} to the caller".format(self.options.tmpdir))
+            cleanup_tree_on_exit = False
+        elif should_clean_up:
             self.log.info("Cleaning up {} on exit".format(self.options.tmpdir))
             cleanup_tree_on_exit = True
         elif self.options.perf:
@@ -238,6 +266,9 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
             self.log.warning("Not cleaning up dir {}".format(self.options.tmpdir))
             cleanup_tree_on_exit = False
 
+        if self.options.statsfile:
+            self._write_stats(cleanup_tmpdir=should_clean_up)
+
         if success == TestStatus.PASSED:
             self.log.info("Tests successful")
             exit_code = TEST_EXIT_PASSED
@@ -268,6 +299,10 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
 
     def setup_chain(self):
         """Override this method to customize blockchain setup"""
+        if self.options.warmnode:
+            assert_equal(self.num_nodes, 1)
+            self.log.info("Using warm node in " + self.options.warmnode)
+            return
         self.log.info("Initializing test directory " + self.options.tmpdir)
         if self.setup_clean_chain:
             self._initialize_chain_clean()
@@ -391,6 +426,102 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
             self.nodes[1].generate(1)
             self.sync_blocks()
 
+    def restore_or_build_snapshot(self, name, build):
+        """Bring the running nodes to the chain state that build() creates.
+
+        The first time, build() is called and the resulting datadirs are saved as
+        a snapshot in the cache directory. Later calls with the same key copy the
+        snapshot into the nodes' datadirs instead of running build() again. The key
+        covers the name, the chain, every node's extra_args (fork heights and other
+        consensus flags) and defid binary (path, mtime and size), every node's tip
+        before build(), setup_clean_chain, whether mocktime is set, --generatechunk
+        and the source of build, so changing any of them builds a new snapshot.
+        Snapshots only pay off for tests with the same num_nodes and extra_args,
+        since saving one costs a restart of all nodes.
+
+        Snapshots are kept in --snapshotdir. test_runner.py points it into the
+        cache directory, which it flushes unless --keepcache is given, so a
+        snapshot lives for one test run. A script run on its own keeps them in
+        its test directory, which is removed with it.
+
+        Nodes are restarted either way, their connections to each other are
+        re-established and mocktime is set to what it was after build(). build()
+        takes no arguments and must leave the nodes in sync, e.g.:
+
+            self.restore_or_build_snapshot("tokens", self.setup_tokens)
+
+        Note that anything build() keeps in Python variables (addresses, token ids)
+        is not restored and has to be looked up again from the nodes."""
+        snapshot_root = self.options.snapshotdir or os.path.join(self.options.tmpdir, 'snapshots')
+        snapshot_dir = os.path.join(snapshot_root, self._snapshot_key(name, build))
+        connections = self._get_node_connections()
+        if os.path.isdir(snapshot_dir):
+            self.log.debug("Restoring chain snapshot {}".format(snapshot_dir))
+            self.stop_nodes()
+            with open(os.path.join(snapshot_dir, 'snapshot.json'), encoding='utf8') as f:
+                TestNode.Mocktime = json.load(f)['mocktime']
+            for i, node in enumerate(self.nodes):
+                chain_dir = os.path.join(node.datadir, self.chain)
+                for entry in os.listdir(chain_dir):
+                    if entry == 'debug.log':
+                        continue
+                    path = os.path.join(chain_dir, entry)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                self._clone_datadir(get_datadir_path(snapshot_dir, i), chain_dir, "node {}".format(i))
+        else:
+            self.log.debug("Building chain snapshot {}".format(snapshot_dir))
+            build()
+            connections = self._get_node_connections()
+            self.stop_nodes()
+            # Build next to the final location and rename, so that tests running
+            # in parallel never see a partial snapshot
+            tmp_dir = "{}.{}.tmp".format(snapshot_dir, os.getpid())
+            for i, node in enumerate(self.nodes):
+                shutil.copytree(os.path.join(node.datadir, self.chain), get_datadir_path(tmp_dir, i), ignore=shutil.ignore_patterns(*SNAPSHOT_IGNORE))
+            with open(os.path.join(tmp_dir, 'snapshot.json'), 'w', encoding='utf8') as f:
+                json.dump({'name': name, 'mocktime': TestNode.Mocktime}, f)
+            try:
+                os.rename(tmp_dir, snapshot_dir)
+            except OSError:
+                # Another test saved the same snapshot first
+                shutil.rmtree(tmp_dir)
+        self.start_nodes()
+        if TestNode.Mocktime is not None:
+            set_node_times(self.nodes, TestNode.Mocktime)
+        for a, b in connections:
+            connect_nodes(self.nodes[a], b)
+        self.sync_blocks()
+
+    def _snapshot_key(self, name, build):
+        try:
+            source = inspect.getsource(build)
+        except (OSError, TypeError):
+            source = None
+        # The chain build() starts from, and the setup that decides which chain and block times it produces
+        tips = [node.getbestblockhash() for node in self.nodes]
+        setup = [self.setup_clean_chain, TestNode.Mocktime is not None, TestNode.GenerateChunk]
+        # A rebuilt defid must not restore a chain written by the previous build
+        binaries = []
+        for node in self.nodes:
+            path = os.path.realpath(shutil.which(node.binary) or node.binary)
+            stat = os.stat(path)
+            binaries.append([path, stat.st_mtime_ns, stat.st_size])
+        key = json.dumps([name, self.chain, [node.extra_args for node in self.nodes], binaries, tips, setup, source])
+        return "{}-{}".format(re.sub(r'[^\w.+-]', '_', name), hashlib.sha256(key.encode('utf-8')).hexdigest()[:16])
+
+    def _get_node_connections(self):
+        """Return (from, to) node index pairs for the outbound connections between test nodes."""
+        connections = []
+        for i, node in enumerate(self.nodes):
+            for peer in node.getpeerinfo():
+                match = re.search(r'testnode(\d+)', peer['subver'])
+                if match and not peer['inbound']:
+                    connections.append((i, int(match.group(1))))
+        return connections
+
     def import_deterministic_coinbase_privkeys(self):
         for n in self.nodes:
             try:
@@ -425,9 +556,10 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
         assert_equal(len(extra_args), num_nodes)
         assert_equal(len(binary), num_nodes)
         for i in range(num_nodes):
+            leased = i == 0 and self.options.warmnode is not None
             self.nodes.append(TestNode(
                 i,
-                get_datadir_path(self.options.tmpdir, i),
+                self.options.warmnode if leased else get_datadir_path(self.options.tmpdir, i),
                 chain=self.chain,
                 rpchost=rpchost,
                 timewait=self.rpc_timeout,
@@ -439,6 +571,8 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
                 extra_args=extra_args[i],
                 use_cli=self.options.usecli,
                 start_perf=self.options.perf,
+                rpc_pool_size=self.options.rpc_pool_size,
+                leased=leased,
             ))
 
     def start_node(self, i, *args, **kwargs):
@@ -526,6 +660,23 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
 
     # Private helper methods. These should not be accessed by the subclass test scripts.
 
+    def _write_stats(self, *, cleanup_tmpdir):
+        try:
+            import resource
+            # Peak memory of this process, which builds large blocks in some tests (kB on Linux, bytes on macOS)
+            test_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == 'darwin' else 1)
+        except ImportError:
+            # Not available on Windows
+            test_rss_kb = 0
+        stats = {
+            'nodes': self.num_nodes,
+            'rss_kb': sum(node.peak_mem_rss_kilobytes for node in self.nodes) + test_rss_kb,
+            'profile': timing.get_summary(),
+            'cleanup_tmpdir': cleanup_tmpdir,
+        }
+        with open(self.options.statsfile, 'w', encoding='utf8') as f:
+            json.dump(stats, f)
+
     def _start_logging(self):
         # Add logger and logging handlers
         self.log = logging.getLogger('TestFramework')
@@ -624,11 +775,15 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
                     os.remove(cache_path(entry))
 
         for i in range(self.num_nodes):
-            self.log.debug("Copy cache directory {} to node {}".format(cache_node_dir, i))
             to_dir = get_datadir_path(self.options.tmpdir, i)
-            shutil.copytree(cache_node_dir, to_dir)
+            self._clone_datadir(cache_node_dir, to_dir, "node {}".format(i))
             initialize_datadir(self.options.tmpdir, i, self.chain)  # Overwrite port/rpcport in defi.conf
 
+    def _clone_datadir(self, from_dir, to_dir, what):
+        stats = clone_datadir(from_dir, to_dir, self.options.clone_mode)
+        self.log.debug("Cloned {} to {} in {:.3f}s: {} bytes, {} reflinked, {} hardlinked, {} copied".format(
+            from_dir, what, stats['seconds'], stats['bytes'], stats['reflink'], stats['hardlink'], stats['copy']))
+
     def _initialize_chain_clean(self):
         """Initialize empty blockchain for use by the test.
 
@@ -19,12 +19,15 @@ import time
 import urllib.parse
 import collections
 import shlex
+import socket
 import sys
 
-from .authproxy import JSONRPCException
+from . import timing
+from .authproxy import IDEMPOTENT_RPCS, JSONRPCException, RPCBatch
 from .util import (
     append_config,
     delete_cookie_file,
+    get_async_rpc_proxy,
     get_rpc_proxy,
     rpc_url,
     wait_until,
@@ -32,6 +35,12 @@ from .util import (
 )
 
 DEFID_PROC_WAIT_TIMEOUT = 60
+# Polling interval bounds for wait_for_rpc_connection(), in seconds
+RPC_CONNECT_MIN_POLL = 0.01
+RPC_CONNECT_MAX_POLL = 0.25
+# defi.conf lines of the nodes in test_runner.py's warm node pool. A leased node
+# keeps running with these, so a test using one can't ask for anything else.
+LEASED_NODE_CONF = ["bind=127.0.0.1"]
 
 
 class FailedToStartError(Exception):
@@ -58,11 +67,16 @@ class TestNode():
     To make things easier for the test writer, any unrecognised messages will
     be dispatched to the RPC connection."""
 
-    def __init__(self, i, datadir, *, chain, rpchost, timewait, defid, defi_cli, coverage_dir, cwd, extra_conf=None, extra_args=None, use_cli=False, start_perf=False):
+    def __init__(self, i, datadir, *, chain, rpchost, timewait, defid, defi_cli, coverage_dir, cwd, extra_conf=None, extra_args=None, use_cli=False, start_perf=False, rpc_pool_size=0, leased=False):
         """
         Kwargs:
             start_perf (bool): If True, begin profiling the node with `perf` as soon as
                 the node starts.
+            rpc_pool_size (int): If non-zero, talk to the node over a pool of that many
+                keep-alive RPC connections (see authproxy.RPCConnectionPool).
+            leased (bool): If True, a defid is already running in datadir (leased from
+                test_runner.py's warm node pool). start() only attaches to it and
+                stop_node() only detaches, the process is left to the pool.
         """
 
         self.index = i
@@ -73,10 +87,15 @@ class TestNode():
         self.chain = chain
         self.rpchost = rpchost
         self.rpc_timeout = timewait
+        self.rpc_pool_size = rpc_pool_size
+        self.leased = leased
         self.binary = defid
         self.coverage_dir = coverage_dir
         self.cwd = cwd
-        if extra_conf is not None:
+        if leased:
+            if not set(extra_conf or []) <= set(LEASED_NODE_CONF):
+                raise AssertionError(self._node_msg("a leased node runs with {}, can't use extra_conf {}".format(LEASED_NODE_CONF, extra_conf)))
+        elif extra_conf is not None:
             append_config(datadir, extra_conf)
         # Most callers will just need to add extra args to the standard list below.
         # For those callers that need more flexibility, they can just set the args property directly.
@@ -110,6 +129,7 @@ class TestNode():
         self.url = None
         self.log = logging.getLogger('TestFramework.node%d' % i)
         self.cleanup_on_exit = True # Whether to kill the node when this object goes away
+        self.peak_mem_rss_kilobytes = 0 # Highest RSS seen when stopping the node, reported to test_runner.py
         # Cache perf subprocesses here by their data output filename.
         self.perf_subprocesses = {}
 
@@ -129,6 +149,8 @@ class TestNode():
         MnKeys("bcrt1qyeuu9rvq8a67j86pzvh5897afdmdjpyankp4mu", "cUX8AEUZYsZxNUh5fTS7ZGnF6SPQuTeTDTABGrp5dbPftCga2zcp", "bcrt1qurwyhta75n2g75u2u5nds9p6w9v62y8wr40d2r", "cUp5EVEjuAGpemSuejP36TWWuFKzuCbUJ4QAKJTiSSB2vXzDLsJW"),
     ]
     Mocktime = None
+    # Blocks requested per generatetoaddress call in generate(), see --generatechunk
+    GenerateChunk = 1
 
     def get_genesis_keys(self):
         """Return a deterministic priv key in base58, that only depends on the node's index"""
@@ -144,9 +166,13 @@ class TestNode():
     def reset_mocktime(self):
         TestNode.Mocktime = None
 
-    def generate(self, nblocks, maxtries=1000000, address=None):
+    def generate(self, nblocks, maxtries=1000000, address=None, chunk=None):
         if address is None:
             address = self.get_genesis_keys().ownerAuthAddress
+        if chunk is None:
+            chunk = TestNode.GenerateChunk
+        if chunk > 1:
+            return self._generate_chunked(nblocks, maxtries, address, chunk)
 
         # height = self.getblockcount()
         minted = 0
@@ -164,6 +190,41 @@ class TestNode():
                 mintedHashes.append(self.getblockhash(self.getblockcount())) # always "tip" due to chain switching (possibly wrong)
         return mintedHashes
 
+    def _generate_chunked(self, nblocks, maxtries, address, chunk):
+        """Mint up to `chunk` blocks per generatetoaddress call.
+
+        Mocktime is moved ahead by the size of the chunk before each call and pulled
+        up to the new tip afterwards, so time advances about one second per block as
+        in the one-at-a-time loop. A chunk that mints fewer blocks (e.g. because the
+        median time past caught up with mocktime) is simply followed by another one.
+
+        generatetoaddress only returns the number of minted blocks, so the tip after
+        each chunk is recorded and the hashes are fetched with a single getblockhash
+        batch at the end, which must contain every recorded tip at its height. A
+        reorg while minting thus fails instead of returning blocks of another chain."""
+        height = self.getblockcount()
+        minted = 0
+        tips = []
+        i = 0
+        while minted < nblocks and i < maxtries:
+            count = min(chunk, nblocks - minted, maxtries - i)
+            if TestNode.Mocktime is not None:
+                self.setmocktime(TestNode.Mocktime + count)
+            res = self.generatetoaddress(nblocks=count, address=address, maxtries=count)
+            i += count
+            if res > 0:
+                minted += res
+                tip = self.getblockheader(self.getbestblockhash())
+                TestNode.Mocktime = tip["time"]
+                tips.append((height + minted, tip))
+        with self.batched() as batch:
+            hashes = [batch.getblockhash(h) for h in range(height + 1, height + minted + 1)]
+        hashes = [h.result() for h in hashes]
+        for expected_height, tip in tips:
+            if tip["height"] != expected_height or hashes[expected_height - height - 1] != tip["hash"]:
+                raise AssertionError("generate: tip {} at height {} after minting up to height {} is not in the chain of the minted blocks".format(
+                    tip["hash"], tip["height"], expected_height))
+        return hashes
 
     def get_mem_rss_kilobytes(self):
         """Get the memory usage (RSS) per `ps`.
@@ -215,6 +276,13 @@ class TestNode():
         if extra_args is None:
             extra_args = self.extra_args
 
+        if self.leased:
+            if extra_args:
+                raise AssertionError(self._node_msg("a leased node is already running, can't start it with extra_args {}".format(extra_args)))
+            self.running = True
+            self.log.debug("Attaching to leased defid, waiting for RPC")
+            return
+
         # Add a new stdout and stderr file each time defid is started
         if stderr is None:
             stderr = tempfile.NamedTemporaryFile(dir=self.stderr_dir, delete=False)
@@ -242,16 +310,27 @@ class TestNode():
         if self.start_perf:
             self._start_perf()
 
+    @timing.timed_function('node.start')
     def wait_for_rpc_connection(self):
-        """Sets up an RPC connection to the defid process. Returns False if unable to connect."""
-        # Poll at a rate of four times per second
-        poll_per_s = 4
-        for _ in range(poll_per_s * self.rpc_timeout):
-            if self.process.poll() is not None:
+        """Sets up an RPC connection to the defid process. Returns False if unable to connect.
+
+        Polls with a growing interval, starting at RPC_CONNECT_MIN_POLL. The
+        credentials are read once the cookie file exists and the RPC port is probed
+        with a plain socket until it accepts connections. Only then is a proxy
+        created, and the same proxy is reused while the node is warming up."""
+        rpc = None
+        poll_interval = RPC_CONNECT_MIN_POLL
+        time_end = time.time() + self.rpc_timeout
+        while time.time() < time_end:
+            if self.process is not None and self.process.poll() is not None:
                 raise FailedToStartError(self._node_msg(
                     'defid exited with status {} during initialization'.format(self.process.returncode)))
             try:
-                rpc = get_rpc_proxy(rpc_url(self.datadir, self.index, self.chain, self.rpchost), self.index, timeout=self.rpc_timeout, coveragedir=self.coverage_dir)
+                if rpc is None:
+                    url = rpc_url(self.datadir, self.index, self.chain, self.rpchost)
+                    parsed = urllib.parse.urlparse(url)
+                    socket.create_connection((parsed.hostname, parsed.port), timeout=self.rpc_timeout).close()
+                    rpc = get_rpc_proxy(url, self.index, timeout=self.rpc_timeout, coveragedir=self.coverage_dir, pool_size=self.rpc_pool_size)
                 rpc.getblockcount()
                 # If the call to getblockcount() succeeds then the RPC connection is up
                 self.log.debug("RPC successfully started")
@@ -269,12 +348,23 @@ class TestNode():
                 # -342 Service unavailable, RPC server started but is shutting down due to error
                 if e.error['code'] != -28 and e.error['code'] != -342:
                     raise  # unknown JSON RPC exception
+                if e.error['code'] == -342:
+                    rpc = None  # The server may be going away, start over with a new connection
             except ValueError as e:  # cookie file not found and no rpcuser or rpcassword. defid still starting
                 if "No RPC credentials" not in str(e):
                     raise
-            time.sleep(1.0 / poll_per_s)
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, RPC_CONNECT_MAX_POLL)
         self._raise_assertion_error("Unable to connect to defid")
 
+    def get_async_rpc(self):
+        """Return an asyncio RPC proxy for this node.
+
+        Its calls are coroutines and must be awaited on the network thread's event
+        loop, e.g. via NetworkThread.run_coroutine()."""
+        assert self.rpc_connected and self.rpc, self._node_msg("RPC not connected")
+        return get_async_rpc_proxy(self.url, self.index, timeout=self.rpc_timeout, coveragedir=self.coverage_dir)
+
     def get_wallet_rpc(self, wallet_name):
         if self.use_cli:
             return self.cli("-rpcwallet={}".format(wallet_name))
@@ -287,7 +377,15 @@ class TestNode():
         """Stop the node."""
         if not self.running:
             return
+        if self.leased:
+            self.log.debug("Detaching from leased node")
+            del self.p2ps[:]
+            self.running = False
+            self.rpc_connected = False
+            self.rpc = None
+            return
         self.log.debug("Stopping node")
+        self.peak_mem_rss_kilobytes = max(self.peak_mem_rss_kilobytes, self.get_mem_rss_kilobytes() or 0)
         try:
             self.stop(wait=wait)
         except http.client.CannotSendRequest:
@@ -330,6 +428,7 @@ class TestNode():
         self.log.debug("Node stopped")
         return True
 
+    @timing.timed_function('node.stop')
     def wait_until_stopped(self, timeout=DEFID_PROC_WAIT_TIMEOUT):
         wait_until(self.is_node_stopped, timeout=timeout)
 
@@ -523,6 +622,25 @@ class TestNode():
 
         return p2p_conn
 
+    def add_p2p_connections(self, p2p_conns, *, wait_for_verack=True, **kwargs):
+        """Add many p2p connections to the node, e.g. P2PLightPeers.
+
+        All connections are opened before waiting for any of them to complete
+        the version handshake. Returns the connections."""
+        if 'dstport' not in kwargs:
+            kwargs['dstport'] = p2p_port(self.index)
+        if 'dstaddr' not in kwargs:
+            kwargs['dstaddr'] = '127.0.0.1'
+
+        for p2p_conn in p2p_conns:
+            p2p_conn.peer_connect(**kwargs)()
+            self.p2ps.append(p2p_conn)
+        if wait_for_verack:
+            for p2p_conn in p2p_conns:
+                p2p_conn.wait_for_verack()
+
+        return p2p_conns
+
     @property
     def p2p(self):
         """Return the first p2p connection
@@ -586,6 +704,12 @@ class TestNodeCLI():
                 results.append(dict(error=e))
         return results
 
+    def call_many(self, requests):
+        return [request() for request in requests]
+
+    def batched(self, idempotent=IDEMPOTENT_RPCS):
+        return RPCBatch(self, idempotent)
+
     def send_cli(self, command=None, *args, **kwargs):
         """Run defi-cli command. Deserializes returned string as python object."""
         pos_args = [arg_to_cli(arg) for arg in args]
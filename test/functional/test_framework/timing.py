@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# Copyright (c) DeFi Blockchain Developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+"""Timing instrumentation for functional tests.
+
+Records where a test spends its time: RPC calls per method, node start and
+stop, sync_* waits and wait_until. Timed sections nest per thread, and time is
+accumulated per stack of section names (e.g. "sync_blocks;rpc.waitforblock"),
+counting only the time not spent in nested sections. This is the "folded
+stacks" format of flame graphs, see test_runner.py --timingreport.
+"""
+
+import collections
+import contextlib
+import functools
+import threading
+import time
+
+_lock = threading.Lock()
+_local = threading.local()
+# Stack path -> [number of calls, seconds not spent in nested sections]
+_totals = collections.defaultdict(lambda: [0, 0.0])
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _add(path, seconds):
+    with _lock:
+        total = _totals[path]
+        total[0] += 1
+        total[1] += seconds
+
+
+@contextlib.contextmanager
+def timed(name):
+    """Time the enclosed block as section `name` of the current stack."""
+    stack = _stack()
+    # [name, seconds spent in nested sections]
+    frame = [name, 0.0]
+    stack.append(frame)
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        path = ';'.join(f[0] for f in stack)
+        stack.pop()
+        if stack:
+            stack[-1][1] += elapsed
+        _add(path, elapsed - frame[1])
+
+
+def record(name, seconds):
+    """Add a section that was timed by the caller, e.g. an RPC awaited on the
+    network thread's event loop, where sections of several coroutines interleave."""
+    stack = _stack()
+    path = ';'.join([f[0] for f in stack] + [name])
+    if stack:
+        stack[-1][1] += seconds
+    _add(path, seconds)
+
+
+def get_summary():
+    """Return {stack path: {'count': n, 'seconds': s}} for everything recorded so far."""
+    with _lock:
+        return {path: {'count': count, 'seconds': seconds} for path, (count, seconds) in _totals.items()}
+
+
+def reset():
+    with _lock:
+        _totals.clear()
+
+
+def timed_function(name):
+    """Decorator that times every call of a function as section `name`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -13,11 +13,13 @@ import logging
 import os
 import random
 import re
+import shutil
 from subprocess import CalledProcessError
+import threading
 import time
 
-from . import coverage
-from .authproxy import AuthServiceProxy, JSONRPCException
+from . import coverage, timing
+from .authproxy import AsyncAuthServiceProxy, AuthServiceProxy, JSONRPCException
 from io import BytesIO
 
 logger = logging.getLogger("TestFramework.utils")
@@ -192,25 +194,53 @@ def str_to_b64str(string):
 def satoshi_round(amount):
     return Decimal(amount).quantize(Decimal('0.00000001'), rounding=ROUND_DOWN)
 
+# Polling interval bounds for wait_until(), in seconds
+WAIT_UNTIL_MIN_POLL = 0.0005
+WAIT_UNTIL_MAX_POLL = 0.05
+
+@timing.timed_function('wait_until')
 def wait_until(predicate, *, attempts=float('inf'), timeout=float('inf'), lock=None):
+    """Wait until predicate() returns true.
+
+    The predicate is polled with an exponential backoff from WAIT_UNTIL_MIN_POLL
+    to WAIT_UNTIL_MAX_POLL seconds. If lock is a threading.Condition (such as
+    mininode_lock), it is held while the predicate runs and a notify_all() on
+    it wakes the wait immediately. Instead of a callable, predicate can be an
+    event: a threading.Event is waited on directly, anything else with an
+    is_set() method (e.g. asyncio.Event) is polled."""
     if attempts == float('inf') and timeout == float('inf'):
         timeout = 60
     attempt = 0
     time_end = time.time() + timeout
+    poll_interval = WAIT_UNTIL_MIN_POLL
+    event = None
+    if hasattr(predicate, 'is_set'):
+        event, predicate = predicate, predicate.is_set
 
     while attempt < attempts and time.time() < time_end:
         if lock:
             with lock:
                 if predicate():
                     return
+                attempt += 1
+                if isinstance(lock, threading.Condition):
+                    lock.wait(max(0, min(poll_interval, time_end - time.time())))
         else:
             if predicate():
                 return
-        attempt += 1
-        time.sleep(0.05)
+            attempt += 1
+        if not isinstance(lock, threading.Condition):
+            if isinstance(event, threading.Event):
+                event.wait(max(0, min(poll_interval, time_end - time.time())))
+            else:
+                time.sleep(poll_interval)
+        poll_interval = min(poll_interval * 2, WAIT_UNTIL_MAX_POLL)
 
     # Print the cause of the timeout
-    predicate_source = "''''\n" + inspect.getsource(predicate) + "'''"
+    if event is not None:
+        predicate_source = repr(event)
+    else:
+        predicate_source = "''''\n" + inspect.getsource(predicate) + "'''"
     logger.error("wait_until() failed. Predicate: {}".format(predicate_source))
     if attempt >= attempts:
         raise AssertionError("Predicate {} not true after {} attempts".format(predicate_source, attempts))
@@ -232,7 +262,7 @@ class PortSeed:
     # Must be initialized with a unique integer for each process
     n = None
 
-def get_rpc_proxy(url, node_number, timeout=None, coveragedir=None):
+def get_rpc_proxy(url, node_number, timeout=None, coveragedir=None, pool_size=0):
     """
     Args:
         url (str): URL of the RPC server to call
@@ -240,6 +270,8 @@ def get_rpc_proxy(url, node_number, timeout=None, coveragedir=None):
 
     Kwargs:
         timeout (int): HTTP timeout in seconds
+        pool_size (int): number of keep-alive connections to pool and pipeline
+            requests over (0 to use a single connection)
 
     Returns:
         AuthServiceProxy. convenience object for making RPC calls.
@@ -248,6 +280,8 @@ def get_rpc_proxy(url, node_number, timeout=None, coveragedir=None):
     proxy_kwargs = {}
     if timeout is not None:
         proxy_kwargs['timeout'] = timeout
+    if pool_size:
+        proxy_kwargs['pool_size'] = pool_size
 
     proxy = AuthServiceProxy(url, **proxy_kwargs)
     proxy.url = url  # store URL on proxy for info
@@ -257,6 +291,32 @@ def get_rpc_proxy(url, node_number, timeout=None, coveragedir=None):
 
     return coverage.AuthServiceProxyWrapper(proxy, coverage_logfile)
 
+def get_async_rpc_proxy(url, node_number, timeout=None, coveragedir=None):
+    """
+    Args:
+        url (str): URL of the RPC server to call
+        node_number (int): the node number (or id) that this calls to
+
+    Kwargs:
+        timeout (int): HTTP timeout in seconds
+
+    Returns:
+        AsyncAuthServiceProxy. calls return coroutines to await on the
+        network thread's event loop.
+
+    """
+    proxy_kwargs = {}
+    if timeout is not None:
+        proxy_kwargs['timeout'] = timeout
+
+    proxy = AsyncAuthServiceProxy(url, **proxy_kwargs)
+    proxy.url = url  # store URL on proxy for info
+
+    coverage_logfile = coverage.get_filename(
+        coveragedir, node_number) if coveragedir else None
+
+    return coverage.AsyncAuthServiceProxyWrapper(proxy, coverage_logfile)
+
 def p2p_port(n):
     assert n <= MAX_NODES
     return PORT_MIN + n + (MAX_NODES * PortSeed.n) % (PORT_RANGE - 1 - MAX_NODES)
@@ -301,6 +361,62 @@ def initialize_datadir(dirname, n, chain):
 def get_datadir_path(dirname, n):
     return os.path.join(dirname, "node" + str(n))
 
+# ioctl request to share a file's extents with another file (Linux, btrfs/xfs/...)
+FICLONE = 0x40049409
+
+def reflink_file(src, dst):
+    """Make dst a copy-on-write clone of src. Raises OSError if unsupported."""
+    import fcntl
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        os.remove(dst)
+        raise
+    shutil.copystat(src, dst)
+
+def is_immutable_datadir_file(name):
+    """LevelDB tables are never modified once written, only deleted, so a
+    hardlink to the cache is safe. Block and undo files are appended to."""
+    return name.endswith('.ldb')
+
+def clone_datadir(src, dst, mode='auto'):
+    """Copy the directory tree src to dst, which may already exist.
+
+    With mode 'auto' each file is reflinked if the filesystem supports it,
+    LevelDB tables that cannot be reflinked are hardlinked and everything else
+    is copied. Mode 'copy' always copies. Returns a dict with the number of
+    files cloned each way, the bytes cloned and the time taken."""
+    stats = {'reflink': 0, 'hardlink': 0, 'copy': 0, 'bytes': 0}
+    start = time.time()
+    reflink = mode == 'auto'
+    for root, dirs, files in os.walk(src):
+        to_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(to_root, exist_ok=True)
+        for name in files:
+            from_path = os.path.join(root, name)
+            to_path = os.path.join(to_root, name)
+            stats['bytes'] += os.path.getsize(from_path)
+            if reflink:
+                try:
+                    reflink_file(from_path, to_path)
+                    stats['reflink'] += 1
+                    continue
+                except (ImportError, OSError):
+                    # Don't try again for every file on a filesystem without reflinks
+                    reflink = False
+            if mode == 'auto' and is_immutable_datadir_file(name):
+                try:
+                    os.link(from_path, to_path)
+                    stats['hardlink'] += 1
+                    continue
+                except OSError:
+                    pass
+            shutil.copy2(from_path, to_path)
+            stats['copy'] += 1
+    stats['seconds'] = time.time() - start
+    return stats
+
 def append_config(datadir, options):
     with open(os.path.join(datadir, "defi.conf"), 'a', encoding='utf8') as f:
         for option in options:
@@ -365,37 +481,85 @@ def connect_nodes_bi(nodes, a, b):
     connect_nodes(nodes[a], b)
     connect_nodes(nodes[b], a)
 
+@timing.timed_function('sync_blocks')
+@coverage.untracked_function
 def sync_blocks(rpc_connections, *, wait=1, timeout=60):
     """
     Wait until everybody has the same tip.
 
+    Instead of sleeping between polls, nodes that lag behind are long-polled
+    with waitforblock for the tip of the highest node, so this returns as soon
+    as they catch up. `wait` bounds a single round of long-polls.
+
     sync_blocks needs to be called with an rpc_connections set that has least
     one node already synced to the latest, stable tip, otherwise there's a
     chance it might return before all nodes are stably synced.
+
+    Its RPC calls are not logged for RPC coverage.
     """
     stop_time = time.time() + timeout
     while time.time() <= stop_time:
-        best_hash = [x.getbestblockhash() for x in rpc_connections]
+        # Tip hash and height from one call, so they always describe the same block
+        tips = [x.getblockchaininfo() for x in rpc_connections]
+        best_hash = [tip['bestblockhash'] for tip in tips]
         if best_hash.count(best_hash[0]) == len(rpc_connections):
             return
-        time.sleep(wait)
-    raise AssertionError("Block sync timed out:{}".format("".join("\n  {!r}".format(b) for b in best_hash)))
-
-def sync_mempools(rpc_connections, *, wait=1, timeout=60, flush_scheduler=True):
+        heights = [tip['blocks'] for tip in tips]
+        target = best_hash[heights.index(max(heights))]
+        poll_end = min(time.time() + wait, stop_time)
+        for x, tip in zip(rpc_connections, best_hash):
+            if tip == target:
+                continue
+            remaining = poll_end - time.time()
+            if remaining <= 0:
+                break
+            # A timeout of 0 would mean "wait forever"
+            x.waitforblock(target, max(1, int(remaining * 1000)))
+    tips = [(tip['blocks'], tip['bestblockhash']) for tip in (x.getblockchaininfo() for x in rpc_connections)]
+    max_height = max(height for height, _ in tips)
+    raise AssertionError("Block sync timed out:{}".format("".join(
+        "\n  {!r} height={} lag={}".format(b, height, max_height - height) for height, b in tips)))
+
+def mempool_fingerprint(rpc_connection):
+    """Return a cheap summary of a node's mempool: (number of txs, total tx size).
+
+    Two pools with different fingerprints differ; equal fingerprints still
+    need a full getrawmempool comparison."""
+    info = rpc_connection.getmempoolinfo()
+    return info['size'], info['bytes']
+
+@timing.timed_function('sync_mempools')
+@coverage.untracked_function
+def sync_mempools(rpc_connections, *, wait=1, timeout=60, flush_scheduler=True, use_fingerprint=True):
     """
     Wait until everybody has the same transactions in their memory
     pools
+
+    The pools are polled with an exponential backoff, starting at 50ms and
+    capped at `wait` seconds. The first poll compares the full txid lists. If
+    they differ and use_fingerprint is set, the following polls compare
+    mempool_fingerprint() first and only download the full txid lists again
+    once those agree. Its RPC calls are not logged for RPC coverage.
     """
     stop_time = time.time() + timeout
+    poll_interval = min(0.05, wait)
+    poll_fingerprints = False
     while time.time() <= stop_time:
-        pool = [set(r.getrawmempool()) for r in rpc_connections]
-        if pool.count(pool[0]) == len(rpc_connections):
-            if flush_scheduler:
-                for r in rpc_connections:
-                    r.syncwithvalidationinterfacequeue()
-            return
-        time.sleep(wait)
-    raise AssertionError("Mempool sync timed out:{}".format("".join("\n  {!r}".format(m) for m in pool)))
+        if poll_fingerprints:
+            fingerprints = [mempool_fingerprint(r) for r in rpc_connections]
+        if not poll_fingerprints or fingerprints.count(fingerprints[0]) == len(rpc_connections):
+            pool = [set(r.getrawmempool()) for r in rpc_connections]
+            if pool.count(pool[0]) == len(rpc_connections):
+                if flush_scheduler:
+                    for r in rpc_connections:
+                        r.syncwithvalidationinterfacequeue()
+                return
+            poll_fingerprints = use_fingerprint
+        time.sleep(poll_interval)
+        poll_interval = min(poll_interval * 2, wait)
+    pool = [set(r.getrawmempool()) for r in rpc_connections]
+    raise AssertionError("Mempool sync timed out:{}".format("".join(
+        "\n  size={} missing={!r} unexpected={!r}".format(len(m), sorted(pool[0] - m), sorted(m - pool[0])) for m in pool)))
 
 # Transaction/Block functions
 #############################
@@ -14,15 +14,20 @@ For a description of arguments recognized by test scripts, see
 
 import argparse
 from collections import deque
+import concurrent.futures
 import configparser
 import datetime
+import json
 import os
+import queue
 import time
 import shutil
 import signal
 import sys
 import subprocess
 import tempfile
+import threading
+import unittest
 import re
 import logging
 
@@ -171,6 +176,7 @@ BASE_SCRIPTS = [
     'feature_any_accounts_to_accounts.py',
     'feature_sendtokenstoaddress.py',
     'feature_poolswap.py',
+    'feature_chain_snapshot.py',
     'feature_poolswap_composite.py',
     'feature_poolswap_mechanism.py',
     'feature_poolswap_mainnet.py',
@@ -199,6 +205,8 @@ BASE_SCRIPTS = [
     'mining_prioritisetransaction.py',
     'p2p_invalid_locator.py',
     'p2p_invalid_block.py',
+    'p2p_traffic_generator.py',
+    'p2p_many_peers.py',
     'p2p_invalid_messages.py',
     'p2p_invalid_tx.py',
     'feature_assumevalid.py',
@@ -226,6 +234,7 @@ BASE_SCRIPTS = [
     'rpc_bind.py --ipv6',
     'rpc_bind.py --nonloopback',
     'mining_basic.py',
+    'mining_generate_chunk.py',
     'wallet_bumpfee.py',
     'wallet_bumpfee_totalfee_deprecation.py',
     'rpc_named_arguments.py',
@@ -235,6 +244,8 @@ BASE_SCRIPTS = [
     'feature_dersig.py',
     'feature_cltv.py',
     'rpc_uptime.py',
+    'rpc_pipelining.py',
+    'rpc_async.py',
     'feature_longterm_lockin.py',
     'wallet_resendwallettransactions.py',
     'feature_custom_poolreward.py',
@@ -293,10 +304,44 @@ BASE_SCRIPTS = [
 # Place EXTENDED_SCRIPTS first since it has the 3 longest running tests
 ALL_SCRIPTS = EXTENDED_SCRIPTS + BASE_SCRIPTS
 
+# Resources that tests need beyond what their node count suggests, for scheduling
+# with --cpus/--maxmem. 'rss_kb' is the peak memory of the nodes and the test
+# process, used until a run of the test has recorded it in the --timingsfile;
+# tests that build large blocks or chains need much more than DEFAULT_NODE_RSS_KB.
+TEST_RESOURCES = {
+    'feature_block.py': {'cpus': 4, 'rss_kb': 1024 * 1024},
+    'feature_dbcrash.py': {'cpus': 4},
+    'feature_maxuploadtarget.py': {'rss_kb': 600 * 1024},
+    'p2p_segwit.py': {'cpus': 3, 'rss_kb': 800 * 1024},
+    'feature_pruning.py': {'cpus': 3, 'rss_kb': 6 * 300 * 1024},
+}
+
+# Single-node tests that only use RPC and leave no state behind but blocks and
+# mocktime, so they can run on a node from the --warmnodes pool
+WARM_NODE_SCRIPTS = [
+    'rpc_help.py',
+    'rpc_misc.py',
+    'rpc_named_arguments.py',
+    'rpc_uptime.py',
+]
+
+# Memory assumed per node for tests that have no recorded memory use yet
+DEFAULT_NODE_RSS_KB = 150 * 1024
+
+# Framework modules with unittest self-tests, run before the functional tests
+TEST_FRAMEWORK_MODULES = [
+    "combine_logs",
+    "query_logs",
+    "test_framework.authproxy",
+    "test_framework.messages",
+    "test_framework.mininode",
+]
+
 NON_SCRIPTS = [
     # These are python files that live in the functional tests directory, but are not test scripts.
     "combine_logs.py",
     "create_cache.py",
+    "query_logs.py",
     "test_runner.py",
 ]
 
@@ -321,6 +366,15 @@ def main():
     parser.add_argument('--tmpdirprefix', '-t', default=tempfile.gettempdir(), help="Root directory for datadirs")
     parser.add_argument('--failfast', action='store_true', help='stop execution after the first test failure')
     parser.add_argument('--filter', help='filter scripts to run by regular expression')
+    parser.add_argument('--cpus', type=float, help='CPU budget for parallel tests. Each test counts as one CPU per node (or as declared in TEST_RESOURCES); tests are only started while they fit. --jobs still limits the number of tests.')
+    parser.add_argument('--maxmem', type=int, metavar='MB', help='memory budget in MB for parallel tests, checked against the peak memory of the nodes and test process recorded for each test in previous runs (or declared in TEST_RESOURCES)')
+    parser.add_argument('--warmnodes', type=int, default=0, metavar='n', help='keep up to n defid nodes running (per kind of chain) and lease them to the tests in WARM_NODE_SCRIPTS instead of starting fresh nodes for each')
+    parser.add_argument('--shard', help='only run shard i of n (e.g. 2/4) of the selected tests, so that several machines can split one run')
+    parser.add_argument('--changedrpcs', help='only run the tests that call any of these comma-separated RPCs, according to the impact map from earlier --coverage runs (tests missing from the map are run too)')
+    parser.add_argument('--impactmap', help='JSON file mapping each test to the RPCs it calls, updated by --coverage runs and read by --changedrpcs (default: test/functional_rpc_impact.json in the build directory)')
+    parser.add_argument('--cleanupjobs', type=int, default=2, help='how many test directories to remove or combine logs of in the background at once. Default=2.')
+    parser.add_argument('--timingreport', metavar='FILE', help='write the time each test spent per RPC method, node start/stop, sync and wait_until to FILE in folded-stack format (for flamegraph.pl) and print the overall hot spots')
+    parser.add_argument('--timingsfile', help='JSON file with the runtime of each test from previous runs, used to start the longest tests first (default: test/functional_timings.json in the build directory)')
 
     args, unknown_args = parser.parse_known_args()
     if not args.ansi:
@@ -402,6 +456,16 @@ def main():
     if args.filter:
         test_list = list(filter(re.compile(args.filter).search, test_list))
 
+    impact_map_file = args.impactmap or "%s/test/functional_rpc_impact.json" % config["environment"]["BUILDDIR"]
+    if args.changedrpcs:
+        test_list = select_impacted_tests(test_list, impact_map_file, set(args.changedrpcs.split(',')))
+
+    if args.shard:
+        try:
+            test_list = select_shard(test_list, args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+
     if not test_list:
         print("No valid test scripts specified. Check that your test is in one "
               "of the test lists in test_runner.py, or run test_runner.py with no arguments to run all tests")
@@ -431,9 +495,17 @@ def main():
         failfast=args.failfast,
         runs_ci=args.ci,
         use_term_control=args.ansi,
+        timings_file=args.timingsfile or "%s/test/functional_timings.json" % config["environment"]["BUILDDIR"],
+        cpu_budget=args.cpus,
+        mem_budget_kb=args.maxmem * 1024 if args.maxmem else None,
+        warm_nodes=args.warmnodes,
+        exeext=config["environment"]["EXEEXT"],
+        impact_map_file=impact_map_file,
+        timing_report_file=args.timingreport,
+        cleanup_jobs=args.cleanupjobs,
     )
 
-def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=False, args=None, combined_logs_len=0, failfast=False, runs_ci, use_term_control):
+def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=False, args=None, combined_logs_len=0, failfast=False, runs_ci, use_term_control, timings_file=None, cpu_budget=None, mem_budget_kb=None, warm_nodes=0, exeext="", impact_map_file=None, timing_report_file=None, cleanup_jobs=2):
     args = args or []
 
     # Warn if defid is already running (unix only)
@@ -449,17 +521,34 @@ def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=
         print("%sWARNING!%s There is a cache directory here: %s. If tests fail unexpectedly, try deleting the cache directory." % (BOLD[1], BOLD[0], cache_dir))
 
     tests_dir = src_dir + '/test/functional/'
-
-    flags = ['--cachedir={}'.format(cache_dir)] + args
+    # Make the framework importable when test_runner.py is run from the build directory
+    sys.path.append(tests_dir)
+
+    # Test the framework itself before running tests with it, without its debug logging
+    logging.getLogger("TestFramework").setLevel(logging.INFO)
+    logging.getLogger("DefiRPC").setLevel(logging.INFO)
+    test_framework_tests = unittest.TestSuite()
+    for module in TEST_FRAMEWORK_MODULES:
+        test_framework_tests.addTest(unittest.TestLoader().loadTestsFromName(module))
+    result = unittest.TextTestRunner(verbosity=1, failfast=True).run(test_framework_tests)
+    if not result.wasSuccessful():
+        logging.debug("Early exiting after failure in TestFramework unit tests")
+        sys.exit(False)
+
+    flags = ['--cachedir={}'.format(cache_dir), '--snapshotdir={}'.format(os.path.join(cache_dir, 'snapshots'))] + args
 
     if enable_coverage:
         coverage = RPCCoverage()
-        flags.append(coverage.flag)
         logging.debug("Initializing coverage directory at %s" % coverage.dir)
+        impact_map = read_impact_map(impact_map_file)
     else:
         coverage = None
 
-    if len(test_list) > 1 and jobs > 1:
+    warm_tests = [test for test in test_list if test in WARM_NODE_SCRIPTS]
+    if warm_nodes and not warm_tests:
+        warm_nodes = 0
+
+    if (len(test_list) > 1 and jobs > 1) or warm_nodes:
         # Populate cache
         try:
             subprocess.check_output([sys.executable, tests_dir + 'create_cache.py'] + flags + ["--tmpdir=%s/cache" % tmpdir])
@@ -467,24 +556,50 @@ def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=
             sys.stdout.buffer.write(e.output)
             raise
 
+    timings = TestTimings(timings_file, tests_dir)
+    test_list = timings.schedule(test_list)
+
+    if warm_nodes:
+        # Port seeds above those of the tests, which use 0..len(test_list)-1
+        node_pool = WarmNodePool(size=warm_nodes, build_dir=build_dir, exeext=exeext, cache_dir=cache_dir, tmpdir=tmpdir, first_port_seed=len(test_list) + 1)
+        node_pool.start(set(is_clean_chain_test(tests_dir, test) for test in warm_tests))
+    else:
+        node_pool = None
+
     #Run Tests
     job_queue = TestHandler(
         num_tests_parallel=jobs,
         tests_dir=tests_dir,
         tmpdir=tmpdir,
         test_list=test_list,
-        flags=flags,
+        # Test directories are removed by the background workers below
+        flags=flags + ['--deferredcleanup'],
         timeout_duration=40 * 60 if runs_ci else float('inf'),  # in seconds
         use_term_control=use_term_control,
+        resources=timings.get_resources if cpu_budget or mem_budget_kb else None,
+        cpu_budget=cpu_budget,
+        mem_budget_kb=mem_budget_kb,
+        node_pool=node_pool,
+        coverage=coverage,
     )
     start_time = time.time()
     test_results = []
+    # Removing test directories and combining logs is disk bound, so it's done
+    # in the background to not hold up starting the next tests
+    background = concurrent.futures.ThreadPoolExecutor(max_workers=max(cleanup_jobs, 1))
+    combined_logs = []
 
     max_len_name = len(max(test_list, key=len))
     test_count = len(test_list)
     for i in range(test_count):
+        print_combined_logs(combined_logs, combined_logs_len)
         test_result, testdir, stdout, stderr = job_queue.get_next()
         test_results.append(test_result)
+        timings.record(test_result)
+        if test_result.stats.get('cleanup_tmpdir'):
+            background.submit(shutil.rmtree, testdir, ignore_errors=True)
+        if coverage and test_result.status == "Passed":
+            impact_map[test_result.name] = sorted(coverage.get_test_rpc_commands(testdir))
         done_str = "{}/{} - {}{}{}".format(i + 1, test_count, BOLD[1], test_result.name, BOLD[0])
         if test_result.status == "Passed":
             logging.debug("%s passed, Duration: %s s" % (done_str, test_result.time))
@@ -495,31 +610,34 @@ def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=
             print(BOLD[1] + 'stdout:\n' + BOLD[0] + stdout + '\n')
             print(BOLD[1] + 'stderr:\n' + BOLD[0] + stderr + '\n')
             if combined_logs_len and os.path.isdir(testdir):
-                # Print the final `combinedlogslen` lines of the combined logs
-                print('{}Combine the logs and print the last {} lines ...{}'.format(BOLD[1], combined_logs_len, BOLD[0]))
-                print('\n============')
-                print('{}Combined log for {}:{}'.format(BOLD[1], testdir, BOLD[0]))
-                print('============\n')
-                combined_logs_args = [sys.executable, os.path.join(tests_dir, 'combine_logs.py'), testdir]
-                if BOLD[0]:
-                    combined_logs_args += ['--color']
-                combined_logs, _ = subprocess.Popen(combined_logs_args, universal_newlines=True, stdout=subprocess.PIPE).communicate()
-                print("\n".join(deque(combined_logs.splitlines(), combined_logs_len)))
+                combined_logs.append((testdir, background.submit(combine_logs, tests_dir, testdir)))
 
             if failfast:
                 logging.debug("Early exiting after test failure")
                 break
 
+    print_combined_logs(combined_logs, combined_logs_len, wait=True)
+    background.shutdown(wait=True)
+
     print_results(test_results, max_len_name, (int(time.time() - start_time)))
+    timings.save()
+    if timing_report_file:
+        write_timing_report(test_results, timing_report_file)
 
     if coverage:
         coverage_passed = coverage.report_rpc_coverage()
+        if impact_map_file:
+            with open(impact_map_file, 'w', encoding="utf8") as f:
+                json.dump(impact_map, f, indent=1, sort_keys=True)
 
         logging.debug("Cleaning up coverage data")
         coverage.cleanup()
     else:
         coverage_passed = True
 
+    if node_pool:
+        node_pool.stop()
+
     # Clear up the temp directory if all subdirectories are gone
     if not os.listdir(tmpdir):
         os.rmdir(tmpdir)
@@ -532,6 +650,24 @@ def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=
 
     sys.exit(not all_passed)
 
+def combine_logs(tests_dir, testdir):
+    combined_logs_args = [sys.executable, os.path.join(tests_dir, 'combine_logs.py'), testdir]
+    if BOLD[0]:
+        combined_logs_args += ['--color']
+    output, _ = subprocess.Popen(combined_logs_args, universal_newlines=True, stdout=subprocess.PIPE).communicate()
+    return output
+
+def print_combined_logs(combined_logs, combined_logs_len, wait=False):
+    """Print the final `combinedlogslen` lines of the combined logs that are ready, or of all of them with wait."""
+    for testdir, future in list(combined_logs):
+        if not wait and not future.done():
+            continue
+        combined_logs.remove((testdir, future))
+        print('\n============')
+        print('{}Combined log for {} (last {} lines):{}'.format(BOLD[1], testdir, combined_logs_len, BOLD[0]))
+        print('============\n')
+        print("\n".join(deque(future.result().splitlines(), combined_logs_len)))
+
 def print_results(test_results, max_len_name, runtime):
     results = "\n" + BOLD[1] + "%s | %s | %s\n\n" % ("TEST".ljust(max_len_name), "STATUS   ", "DURATION") + BOLD[0]
 
@@ -559,7 +695,7 @@ class TestHandler:
     Trigger the test scripts passed in via the list.
     """
 
-    def __init__(self, *, num_tests_parallel, tests_dir, tmpdir, test_list, flags, timeout_duration, use_term_control):
+    def __init__(self, *, num_tests_parallel, tests_dir, tmpdir, test_list, flags, timeout_duration, use_term_control, resources=None, cpu_budget=None, mem_budget_kb=None, node_pool=None, coverage=None):
         assert num_tests_parallel >= 1
         self.num_jobs = num_tests_parallel
         self.tests_dir = tests_dir
@@ -570,12 +706,50 @@ class TestHandler:
         self.num_running = 0
         self.jobs = []
         self.use_term_control = use_term_control
+        # Callable returning the (cpus, memory in kB) a test needs, see TestTimings.get_resources()
+        self.resources = resources
+        self.cpu_budget = cpu_budget or float('inf')
+        self.mem_budget_kb = mem_budget_kb or float('inf')
+        self.cpus_used = 0
+        self.mem_used_kb = 0
+        # Processes that have exited, put there by one waiter thread per job
+        self.finished = queue.Queue()
+        self.node_pool = node_pool
+        # Warm nodes leased by running tests, by process
+        self.leases = {}
+        # (cpus, memory in kB) reserved for running tests, by process
+        self.reservations = {}
+        self.coverage = coverage
+
+    def _pop_next_test(self):
+        """Return the first test in the list that fits in the remaining budget and
+        the (cpus, memory in kB) reserved for it, or (None, None)."""
+        if self.resources is None:
+            return self.test_list.pop(0), None
+        for i, test in enumerate(self.test_list):
+            cpus, mem_kb = self.resources(test)
+            # A test that is too big for the budget runs alone
+            if not self.jobs or (self.cpus_used + cpus <= self.cpu_budget and self.mem_used_kb + mem_kb <= self.mem_budget_kb):
+                self.cpus_used += cpus
+                self.mem_used_kb += mem_kb
+                return self.test_list.pop(i), (cpus, mem_kb)
+        return None, None
+
+    def _release_test(self, proc):
+        """Give back exactly what was reserved when the test was started, even if
+        its recorded resources have changed since."""
+        if proc in self.reservations:
+            cpus, mem_kb = self.reservations.pop(proc)
+            self.cpus_used -= cpus
+            self.mem_used_kb -= mem_kb
 
     def get_next(self):
         while self.num_running < self.num_jobs and self.test_list:
             # Add tests
+            test, reservation = self._pop_next_test()
+            if test is None:
+                break
             self.num_running += 1
-            test = self.test_list.pop(0)
             portseed = len(self.test_list)
             portseed_arg = ["--portseed={}".format(portseed)]
             log_stdout = tempfile.SpooledTemporaryFile(max_size=2**16)
@@ -583,12 +757,26 @@ class TestHandler:
             test_argv = test.split()
             testdir = "{}/{}_{}".format(self.tmpdir, re.sub(".py$", "", test_argv[0]), portseed)
             tmpdir_arg = ["--tmpdir={}".format(testdir)]
+            statsfile_arg = ["--statsfile={}.stats.json".format(testdir)]
+            coverage_arg = [self.coverage.get_flag(testdir)] if self.coverage else []
+            lease = None
+            if self.node_pool and test in WARM_NODE_SCRIPTS:
+                lease = self.node_pool.lease(is_clean_chain_test(self.tests_dir, test))
+            if lease:
+                # The leased node listens on the ports of its own port seed
+                portseed_arg = ["--portseed={}".format(lease.port_seed), "--warmnode={}".format(lease.datadir)]
+            proc = subprocess.Popen([sys.executable, self.tests_dir + test_argv[0]] + test_argv[1:] + self.flags + portseed_arg + tmpdir_arg + statsfile_arg + coverage_arg,
+                                    universal_newlines=True,
+                                    stdout=log_stdout,
+                                    stderr=log_stderr)
+            if lease:
+                self.leases[proc] = lease
+            if reservation:
+                self.reservations[proc] = reservation
+            threading.Thread(target=self._wait_for_exit, args=(proc,), daemon=True).start()
             self.jobs.append((test,
                               time.time(),
-                              subprocess.Popen([sys.executable, self.tests_dir + test_argv[0]] + test_argv[1:] + self.flags + portseed_arg + tmpdir_arg,
-                                               universal_newlines=True,
-                                               stdout=log_stdout,
-                                               stderr=log_stderr),
+                              proc,
                               testdir,
                               log_stdout,
                               log_stderr))
@@ -601,15 +789,19 @@ class TestHandler:
 
         dot_count = 0
         while True:
-            # Return first proc that finishes
-            time.sleep(.5)
+            # Return first proc that finishes. Waking up every .5s keeps the
+            # progress dots and the test timeout going.
+            try:
+                finished_proc = self.finished.get(timeout=.5)
+            except queue.Empty:
+                finished_proc = None
             for job in self.jobs:
                 (name, start_time, proc, testdir, log_out, log_err) = job
                 if int(time.time() - start_time) > self.timeout_duration:
                     # Timeout individual tests if timeout is specified (to stop
                     # tests hanging and not providing useful output).
                     proc.send_signal(signal.SIGINT)
-                if proc.poll() is not None:
+                if proc is finished_proc:
                     log_out.seek(0), log_err.seek(0)
                     [stdout, stderr] = [log_file.read().decode('utf-8') for log_file in (log_out, log_err)]
                     log_out.close(), log_err.close()
@@ -621,15 +813,22 @@ class TestHandler:
                         status = "Failed"
                     self.num_running -= 1
                     self.jobs.remove(job)
+                    self._release_test(proc)
+                    if proc in self.leases:
+                        self.node_pool.release(self.leases.pop(proc), reuse=status == "Passed", testdir=testdir)
                     if self.use_term_control:
                         clearline = '\r' + (' ' * dot_count) + '\r'
                         print(clearline, end='', flush=True)
                     dot_count = 0
-                    return TestResult(name, status, int(time.time() - start_time)), testdir, stdout, stderr
+                    return TestResult(name, status, int(time.time() - start_time), read_test_stats(testdir)), testdir, stdout, stderr
             if self.use_term_control:
                 print('.', end='', flush=True)
             dot_count += 1
 
+    def _wait_for_exit(self, proc):
+        proc.wait()
+        self.finished.put(proc)
+
     def kill_and_join(self):
         """Send SIGKILL to all jobs and block until all have ended."""
         procs = [i[2] for i in self.jobs]
@@ -641,11 +840,24 @@ class TestHandler:
             proc.wait()
 
 
+def read_test_stats(testdir):
+    """Read and remove the file a test script wrote with --statsfile, see DefiTestFramework._write_stats()."""
+    statsfile = "{}.stats.json".format(testdir)
+    try:
+        with open(statsfile, encoding="utf8") as f:
+            stats = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    os.remove(statsfile)
+    return stats
+
+
 class TestResult():
-    def __init__(self, name, status, time):
+    def __init__(self, name, status, time, stats=None):
         self.name = name
         self.status = status
         self.time = time
+        self.stats = stats or {}
         self.padding = 0
 
     def sort_key(self):
@@ -701,6 +913,295 @@ def check_script_list(*, src_dir, fail_on_warn):
             sys.exit(1)
 
 
+def write_timing_report(test_results, report_file, top=20):
+    """Write the per-test profiles from test_framework/timing.py as folded stacks
+    (one "test;section;... microseconds" line per stack) and print the sections
+    that took the most time over all tests."""
+    totals = {}
+    with open(report_file, 'w', encoding="utf8") as f:
+        for test_result in sorted(test_results, key=lambda result: result.name):
+            for path, entry in sorted(test_result.stats.get('profile', {}).items()):
+                f.write("%s;%s %d\n" % (test_result.name.replace(' ', '_'), path, entry['seconds'] * 1e6))
+                total = totals.setdefault(path, [0, 0.0])
+                total[0] += entry['count']
+                total[1] += entry['seconds']
+    results = BOLD[1] + "%s | %s | %s\n\n" % ("SECTION".ljust(40), "CALLS".rjust(8), "SECONDS") + BOLD[0]
+    for path, (count, seconds) in sorted(totals.items(), key=lambda item: item[1][1], reverse=True)[:top]:
+        results += "%s | %s | %.1f\n" % (path.ljust(40), str(count).rjust(8), seconds)
+    print(results)
+    print("Timing report written to %s" % report_file)
+
+
+def select_shard(test_list, shard):
+    """Return shard "i/n" (1 <= i <= n) of test_list.
+
+    Tests are dealt out round-robin in list order, so that the long tests at the
+    start of the lists are spread over all shards."""
+    match = re.match(r"^(\d+)/(\d+)$", shard)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise ValueError("Invalid --shard %s, expected i/n with 1 <= i <= n" % shard)
+    return test_list[int(match.group(1)) - 1::int(match.group(2))]
+
+
+def read_impact_map(impact_map_file):
+    """Return the impact map, or an empty one if the file is missing or malformed."""
+    if not os.path.isfile(impact_map_file):
+        return {}
+    try:
+        with open(impact_map_file, encoding="utf8") as f:
+            impact_map = json.load(f)
+        if not isinstance(impact_map, dict):
+            raise ValueError("expected an object mapping tests to RPCs")
+    except ValueError as e:
+        print("{}WARNING!{} Ignoring malformed RPC impact map {}: {}".format(BOLD[1], BOLD[0], impact_map_file, e))
+        return {}
+    return impact_map
+
+
+def select_impacted_tests(test_list, impact_map_file, changed_rpcs):
+    """Return the tests in test_list that call any of changed_rpcs, or that are not in the impact map."""
+    impact_map = read_impact_map(impact_map_file)
+    if not impact_map:
+        print("{}WARNING!{} No usable RPC impact map at {}, running all tests. Create it with --coverage.".format(BOLD[1], BOLD[0], impact_map_file))
+        return test_list
+    selected = [test for test in test_list if test not in impact_map or changed_rpcs & set(impact_map[test])]
+    logging.debug("%d of %d tests call %s or have no impact data" % (len(selected), len(test_list), ", ".join(sorted(changed_rpcs))))
+    return selected
+
+
+def is_clean_chain_test(tests_dir, test):
+    """Return whether a test script sets self.setup_clean_chain = True."""
+    with open(os.path.join(tests_dir, test.split()[0]), encoding="utf8") as f:
+        return re.search(r"self\.setup_clean_chain\s*=\s*True", f.read()) is not None
+
+
+class WarmNodePool():
+    """
+    defid nodes started once per test run and leased to WARM_NODE_SCRIPTS.
+
+    There are two kinds of nodes: ones on an empty chain for tests with
+    setup_clean_chain, and ones on the cached 199 block chain for the others.
+    A test gets a node's datadir with --warmnode and the node's --portseed,
+    attaches to it as node 0 and leaves it running on exit. The node's debug.log
+    lines written during the test are copied to node0/regtest/debug.log in the
+    test directory, if the test left that behind. When a test passes, the node
+    is reset for the next one: mocktime is cleared, peers and bans are dropped
+    and blocks above the starting height are invalidated. The node is only
+    leased again if that leaves it with an empty mempool at its starting tip.
+    The node of a test that failed is stopped and not leased again.
+
+    """
+    def __init__(self, *, size, build_dir, exeext, cache_dir, tmpdir, first_port_seed):
+        # Imported here so that test_runner.py works without the framework's dependencies otherwise
+        from test_framework.test_node import LEASED_NODE_CONF, TestNode
+        self.LEASED_NODE_CONF = LEASED_NODE_CONF
+        from test_framework.util import PortSeed, clone_datadir, get_datadir_path, initialize_datadir
+        self.TestNode = TestNode
+        self.PortSeed = PortSeed
+        self.clone_datadir = clone_datadir
+        self.get_datadir_path = get_datadir_path
+        self.initialize_datadir = initialize_datadir
+        # Keep the nodes' per-call debug logging out of the runner's output
+        logging.getLogger("TestFramework").setLevel(logging.INFO)
+        logging.getLogger("DefiRPC").setLevel(logging.INFO)
+
+        self.size = size
+        self.defid = os.getenv("DEFID", default=os.path.join(build_dir, "src", "defid" + exeext))
+        self.deficli = os.getenv("DEFICLI", default=os.path.join(build_dir, "src", "defi-cli" + exeext))
+        self.cache_dir = cache_dir
+        self.pool_dir = os.path.join(tmpdir, "warm_nodes")
+        self.next_port_seed = first_port_seed
+        self.idle = {True: [], False: []}
+        self.nodes = []
+
+    def start(self, kinds):
+        """Start `size` nodes of each kind (True for clean chain) in `kinds`."""
+        for clean_chain in kinds:
+            if not clean_chain and not os.path.isdir(self.get_datadir_path(self.cache_dir, 0)):
+                logging.debug("No cached chain, not starting warm nodes for tests on it")
+                continue
+            for _ in range(self.size):
+                self.nodes.append(self._start_node(clean_chain))
+        for lease in self.nodes:
+            self.PortSeed.n = lease.port_seed
+            lease.node.wait_for_rpc_connection()
+            lease.height = lease.node.getblockcount()
+            lease.best_hash = lease.node.getbestblockhash()
+            self.idle[lease.clean_chain].append(lease)
+        logging.debug("Started %d warm nodes in %s" % (len(self.nodes), self.pool_dir))
+
+    def _start_node(self, clean_chain):
+        port_seed = self.next_port_seed
+        self.next_port_seed += 1
+        self.PortSeed.n = port_seed
+        base_dir = os.path.join(self.pool_dir, str(port_seed))
+        datadir = self.get_datadir_path(base_dir, 0)
+        if not clean_chain:
+            self.clone_datadir(self.get_datadir_path(self.cache_dir, 0), datadir)
+        self.initialize_datadir(base_dir, 0, "regtest")
+        node = self.TestNode(
+            0,
+            datadir,
+            chain="regtest",
+            extra_conf=self.LEASED_NODE_CONF,
+            extra_args=[],
+            rpchost=None,
+            timewait=60,
+            defid=self.defid,
+            defi_cli=self.deficli,
+            coverage_dir=None,
+            cwd=base_dir,
+        )
+        node.start()
+        return WarmNode(node, datadir, port_seed, clean_chain)
+
+    def lease(self, clean_chain):
+        """Return an idle node of the given kind, or None if all are in use."""
+        if not self.idle[clean_chain]:
+            return None
+        lease = self.idle[clean_chain].pop()
+        lease.log_offset = os.path.getsize(lease.debug_log)
+        return lease
+
+    def release(self, lease, *, reuse, testdir):
+        """Take a node back from the test that ran in testdir."""
+        if os.path.isdir(testdir):
+            # Like the log of a node the test started itself, e.g. for combine_logs.py
+            try:
+                test_log = os.path.join(self.get_datadir_path(testdir, 0), "regtest", "debug.log")
+                os.makedirs(os.path.dirname(test_log), exist_ok=True)
+                with open(lease.debug_log, 'rb') as src, open(test_log, 'wb') as dst:
+                    src.seek(lease.log_offset)
+                    shutil.copyfileobj(src, dst)
+            except OSError as e:
+                logging.debug("Could not copy the warm node log from %s: %s" % (lease.debug_log, e))
+        if reuse:
+            try:
+                self._reset(lease)
+                self.idle[lease.clean_chain].append(lease)
+                return
+            except Exception as e:
+                logging.debug("Could not reset warm node in %s: %s" % (lease.datadir, e))
+        self._stop_node(lease)
+
+    def _reset(self, lease):
+        node = lease.node
+        node.setmocktime(0)
+        node.setnetworkactive(True)
+        node.clearbanned()
+        for peer in node.getpeerinfo():
+            node.disconnectnode(nodeid=peer['id'])
+        if node.getblockcount() > lease.height:
+            node.invalidateblock(node.getblockhash(lease.height + 1))
+        # Invalidating blocks puts their transactions back in the mempool
+        mempool = node.getrawmempool()
+        if mempool:
+            raise AssertionError("%d transactions left in the mempool" % len(mempool))
+        best_hash = node.getbestblockhash()
+        if best_hash != lease.best_hash:
+            raise AssertionError("tip %s is not the starting tip %s" % (best_hash, lease.best_hash))
+
+    def _stop_node(self, lease):
+        self.nodes.remove(lease)
+        try:
+            lease.node.stop_node()
+            lease.node.wait_until_stopped()
+        except Exception:
+            if lease.node.process:
+                lease.node.process.kill()
+
+    def stop(self):
+        for lease in list(self.nodes):
+            self._stop_node(lease)
+        shutil.rmtree(self.pool_dir, ignore_errors=True)
+
+
+class WarmNode():
+    def __init__(self, node, datadir, port_seed, clean_chain):
+        self.node = node
+        self.datadir = datadir
+        self.port_seed = port_seed
+        self.clean_chain = clean_chain
+        self.debug_log = os.path.join(datadir, "regtest", "debug.log")
+        # Tip when the node was started, restored by WarmNodePool._reset()
+        self.height = 0
+        self.best_hash = None
+        # Size of debug.log when the node was leased
+        self.log_offset = 0
+
+
+class TestTimings():
+    """
+    Runtime, node count and peak node memory of each test script, kept across
+    runs in a JSON file.
+
+    Tests are scheduled longest-processing-time first with this history, so that
+    long tests don't end up starting last and stretching the total runtime. Tests
+    with no history yet (new tests, or the first run) keep their order from the
+    test lists and are started before all others, as they may be long.
+
+    """
+    def __init__(self, path, tests_dir=None):
+        self.path = path
+        self.tests_dir = tests_dir
+        self.timings = {}
+        self.num_nodes = {}
+        if path and os.path.isfile(path):
+            try:
+                with open(path, encoding="utf8") as f:
+                    self.timings = json.load(f)
+            except (OSError, ValueError):
+                logging.debug("Ignoring unreadable test timings file %s" % path)
+
+    def schedule(self, test_list):
+        unknown = [test for test in test_list if test not in self.timings]
+        known = [test for test in test_list if test in self.timings]
+        known.sort(key=lambda test: (self.timings[test]['time'], self.timings[test].get('nodes', 1)), reverse=True)
+        return unknown + known
+
+    def get_nodes(self, test):
+        """Return the node count of a test from its history, or else from the
+        `self.num_nodes = N` line in the script."""
+        if 'nodes' in self.timings.get(test, {}):
+            return self.timings[test]['nodes']
+        script = test.split()[0]
+        if script not in self.num_nodes:
+            self.num_nodes[script] = 1
+            try:
+                with open(os.path.join(self.tests_dir, script), encoding="utf8") as f:
+                    match = re.search(r"self\.num_nodes\s*=\s*(\d+)", f.read())
+                if match:
+                    self.num_nodes[script] = int(match.group(1))
+            except (OSError, TypeError):
+                pass
+        return self.num_nodes[script]
+
+    def get_resources(self, test):
+        """Return the CPUs and memory (kB) to reserve for a test."""
+        nodes = self.get_nodes(test)
+        declared = TEST_RESOURCES.get(test.split()[0], {})
+        cpus = declared.get('cpus', max(nodes, 1))
+        mem_kb = self.timings.get(test, {}).get('rss_kb') or declared.get('rss_kb', nodes * DEFAULT_NODE_RSS_KB)
+        return cpus, mem_kb
+
+    def record(self, test_result):
+        # Failed and skipped runs don't tell how long the test takes
+        if test_result.status != "Passed":
+            return
+        timing = {'time': test_result.time}
+        timing.update((key, test_result.stats[key]) for key in ('nodes', 'rss_kb') if key in test_result.stats)
+        self.timings[test_result.name] = timing
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding="utf8") as f:
+            json.dump(self.timings, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
 class RPCCoverage():
     """
     Coverage reporting utilities for test_runner.
@@ -718,7 +1219,18 @@ class RPCCoverage():
     """
     def __init__(self):
         self.dir = tempfile.mkdtemp(prefix="coverage")
-        self.flag = '--coveragedir=%s' % self.dir
+
+    def get_flag(self, testdir):
+        """
+        Return the --coveragedir argument for the test running in `testdir`.
+
+        Every test writes its coverage files to its own subdirectory, named after
+        its test directory, so that they can be told apart afterwards.
+
+        """
+        test_coverage_dir = os.path.join(self.dir, os.path.basename(testdir))
+        os.makedirs(test_coverage_dir, exist_ok=True)
+        return '--coveragedir=%s' % test_coverage_dir
 
     def report_rpc_coverage(self):
         """
@@ -738,6 +1250,20 @@ class RPCCoverage():
     def cleanup(self):
         return shutil.rmtree(self.dir)
 
+    def get_test_rpc_commands(self, testdir):
+        """
+        Return the set of RPC commands called by the test that ran in `testdir`.
+
+        """
+        # File names come from `get_filename()` in `test/functional/test_framework/coverage.py`
+        test_coverage_dir = os.path.join(self.dir, os.path.basename(testdir))
+        commands = set()
+        for filename in os.listdir(test_coverage_dir):
+            if filename.startswith('coverage.'):
+                with open(os.path.join(test_coverage_dir, filename), 'r', encoding="utf8") as coverage_file:
+                    commands.update(line.strip() for line in coverage_file)
+        return commands
+
     def _get_uncovered_rpc_commands(self):
         """
         Return a set of currently untested RPC commands.
@@ -747,22 +1273,26 @@ class RPCCoverage():
         reference_filename = 'rpc_interface.txt'
         coverage_file_prefix = 'coverage.'
 
-        coverage_ref_filename = os.path.join(self.dir, reference_filename)
+        coverage_ref_filenames = set()
         coverage_filenames = set()
         all_cmds = set()
         covered_cmds = set()
 
-        if not os.path.isfile(coverage_ref_filename):
-            raise RuntimeError("No coverage reference found")
-
-        with open(coverage_ref_filename, 'r', encoding="utf8") as coverage_ref_file:
-            all_cmds.update([line.strip() for line in coverage_ref_file.readlines()])
-
+        # Every test's coverage directory has a reference
         for root, _, files in os.walk(self.dir):
             for filename in files:
-                if filename.startswith(coverage_file_prefix):
+                if filename == reference_filename:
+                    coverage_ref_filenames.add(os.path.join(root, filename))
+                elif filename.startswith(coverage_file_prefix):
                     coverage_filenames.add(os.path.join(root, filename))
 
+        if not coverage_ref_filenames:
+            raise RuntimeError("No coverage reference found")
+
+        for coverage_ref_filename in coverage_ref_filenames:
+            with open(coverage_ref_filename, 'r', encoding="utf8") as coverage_ref_file:
+                all_cmds.update([line.strip() for line in coverage_ref_file.readlines()])
+
         for filename in coverage_filenames:
             with open(filename, 'r', encoding="utf8") as coverage_file:
                 covered_cmds.update([line.strip() for line in coverage_file.readlines()])